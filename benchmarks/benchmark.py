@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+# Benchmark for playbook.integrity sign / verify.
+#
+# Generates a synthetic git playbook repo, signs it with a throwaway gpg key (and a throwaway
+# cosign key pair if cosign is installed), and times every phase for each digest algorithm and
+# worker count, with a cold and a warm digest cache. Results are written as JSON.
+#
+#   $ python3 benchmarks/benchmark.py --files 20000 --workers 1,4,8 --output bench.json
+
+import argparse
+import atexit
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+COLLECTION_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_SIZES = "1024:70,16384:25,262144:4,8388608:1"
+
+
+def import_collection():
+    # inside an installed collection, ansible_collections/ is 3 levels up
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(COLLECTION_ROOT))))
+    try:
+        import ansible_collections.playbook.integrity.plugins.module_utils.common  # noqa: F401
+    except ImportError:
+        # a plain checkout; expose it as ansible_collections.playbook.integrity
+        sys.path.pop(0)
+        link_root = tempfile.mkdtemp(prefix="playbook-integrity-bench-")
+        atexit.register(shutil.rmtree, link_root, True)
+        os.makedirs(os.path.join(link_root, "ansible_collections", "playbook"))
+        os.symlink(COLLECTION_ROOT, os.path.join(link_root, "ansible_collections", "playbook", "integrity"))
+        sys.path.insert(0, link_root)
+    import ansible_collections.playbook.integrity.plugins.module_utils.common as common
+    import ansible_collections.playbook.integrity.plugins.module_utils.sign as sign
+    import ansible_collections.playbook.integrity.plugins.module_utils.verify as verify
+    return common, sign, verify
+
+
+def parse_sizes(sizes):
+    dist = []
+    for item in sizes.split(","):
+        size, _, weight = item.partition(":")
+        dist.append((int(size), float(weight or 1)))
+    return dist
+
+
+def run(argv, cwd=None, env=None):
+    result = subprocess.run(argv, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise RuntimeError("command failed: {}\n{}".format(" ".join(argv), result.stderr))
+    return result.stdout
+
+
+def generate_repo(path, files, sizes, depth, fanout, symlink_ratio, seed):
+    rng = random.Random(seed)
+    dist = parse_sizes(sizes)
+    dirs = [""]
+    level = [""]
+    for _ in range(depth):
+        level = [os.path.join(parent, "dir{}".format(i)) for parent in level for i in range(fanout)]
+        dirs += level
+    os.makedirs(path)
+    total_bytes = 0
+    created = []
+    for i in range(files):
+        fname = os.path.join(rng.choice(dirs), "file{}.yml".format(i))
+        fpath = os.path.join(path, fname)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        if len(created) > 0 and rng.random() < symlink_ratio:
+            os.symlink(os.path.relpath(os.path.join(path, rng.choice(created)), os.path.dirname(fpath)), fpath)
+            continue
+        size = rng.choices([s for s, _ in dist], weights=[w for _, w in dist])[0]
+        with open(fpath, "wb") as f:
+            f.write(rng.randbytes(size) if hasattr(rng, "randbytes") else os.urandom(size))
+        total_bytes += size
+        created.append(fname)
+    env = dict(os.environ, GIT_AUTHOR_NAME="bench", GIT_AUTHOR_EMAIL="bench@example.com",
+               GIT_COMMITTER_NAME="bench", GIT_COMMITTER_EMAIL="bench@example.com")
+    run(["git", "init", "-q"], cwd=path)
+    run(["git", "add", "-A"], cwd=path)
+    run(["git", "commit", "-q", "-m", "synthetic repo"], cwd=path, env=env)
+    return dict(files=files, regular_files=len(created), symlinks=files - len(created), bytes=total_bytes,
+                depth=depth, fanout=fanout, sizes=sizes, seed=seed)
+
+
+def setup_gpg(work_dir):
+    gnupghome = os.path.join(work_dir, "gnupg")
+    os.makedirs(gnupghome, mode=0o700)
+    env = dict(os.environ, GNUPGHOME=gnupghome)
+    run(["gpg", "--batch", "--passphrase", "", "--quick-gen-key", "bench@example.com", "default", "default", "never"], env=env)
+    public_key = os.path.join(work_dir, "bench.gpg")
+    with open(public_key, "w") as f:
+        f.write(run(["gpg", "--armor", "--export", "bench@example.com"], env=env))
+    return gnupghome, public_key
+
+
+def setup_cosign(work_dir):
+    cosign = shutil.which("cosign")
+    if cosign is None:
+        return None
+    env = dict(os.environ, COSIGN_PASSWORD="")
+    run([cosign, "generate-key-pair"], cwd=work_dir, env=env)
+    return dict(cosign_path=cosign, private_key=os.path.join(work_dir, "cosign.key"), public_key=os.path.join(work_dir, "cosign.pub"))
+
+
+def timed(func):
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    result = func()
+    return result, dict(wall=round(time.perf_counter() - wall, 6), cpu=round(time.process_time() - cpu, 6))
+
+
+# every timed phase has a cache dir of its own, so a "cold" phase is not warmed up by the phases before it
+def bench_target(common, sign, verify, repo, workers, cache_dir, base_params):
+    def phase_cache_dir(phase):
+        return os.path.join(cache_dir, phase) if cache_dir is not None else None
+
+    def phase_cache(phase):
+        return common.DigestCache(phase_cache_dir(phase)) if cache_dir is not None else None
+
+    phases = {}
+    cache_stats = {}
+    digester = common.Digester(repo, workers=workers, cache=phase_cache("hash"), digest_algorithm=base_params["digest_algorithm"])
+    (_, fnames), phases["list"] = timed(digester.list_files)
+    _, phases["hash"] = timed(lambda: digester.hash_engine.hash_files(repo, fnames))
+    cache_stats["hash"] = digester.hash_engine.cache_stats()
+
+    params = dict(base_params, target=repo, workers=workers, paranoid=cache_dir is None, digest_cache_dir=phase_cache_dir("sign") or "")
+    sign_result, phases["sign"] = timed(lambda: sign.Signer(params).sign())
+    if sign_result.get("failed", False):
+        raise RuntimeError("signing failed: {}".format(sign_result))
+    cache_stats["sign"] = sign_result["digest_result"].get("cache")
+    # "check" is a whole Digester.check() (list, hash and compare); "compare" is its comparison alone
+    checker = common.Digester(repo, workers=workers, cache=phase_cache("check"), digest_algorithm=base_params["digest_algorithm"])
+    check_result, phases["check"] = timed(checker.check)
+    compare = checker.metrics.as_dict()["phases"].get("compare", dict(wall=0.0, cpu=0.0))
+    phases["compare"] = dict(wall=compare["wall"], cpu=compare["cpu"])
+    cache_stats["check"] = check_result.get("cache")
+    verify_params = dict(params, public_key=base_params["verify_public_key"], digest_cache_dir=phase_cache_dir("verify") or "")
+    verify_result, phases["verify"] = timed(lambda: verify.Verifier(verify_params).verify())
+    if verify_result.get("failed", False):
+        raise RuntimeError("verification failed: {}".format(verify_result))
+    cache_stats["verify"] = verify_result["digest_result"].get("cache")
+    return phases, cache_stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark playbook.integrity sign / verify on a synthetic repo")
+    parser.add_argument("--files", type=int, default=5000)
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="file size distribution as comma separated bytes:weight")
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fanout", type=int, default=4)
+    parser.add_argument("--symlink-ratio", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", default="1,{}".format(os.cpu_count() or 1), help="comma separated worker counts")
+    parser.add_argument("--digest-algorithms", default="sha256", help="comma separated digest algorithms, e.g. sha256,blake2b,blake3")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--output", default="-", help="JSON output file, or - for stdout")
+    parser.add_argument("--keep", action="store_true", help="keep the generated repo and keys")
+    args = parser.parse_args()
+
+    common, sign, verify = import_collection()
+    work_dir = tempfile.mkdtemp(prefix="playbook-integrity-bench-")
+    try:
+        repo = os.path.join(work_dir, "repo")
+        repo_info, generate_time = timed(lambda: generate_repo(repo, args.files, args.sizes, args.depth, args.fanout, args.symlink_ratio, args.seed))
+        gnupghome, public_key = setup_gpg(work_dir)
+        os.environ["GNUPGHOME"] = gnupghome
+        signers = [dict(signature_type=common.SIGNATURE_TYPE_GPG, private_key="", verify_public_key=public_key)]
+        cosign = setup_cosign(work_dir)
+        if cosign is not None:
+            signers.append(dict(signature_type=common.SIGNATURE_TYPE_SIGSTORE, private_key=cosign["private_key"],
+                                verify_public_key=cosign["public_key"], cosign_path=cosign["cosign_path"]))
+        # files changed within this window are never cached, see DigestCache
+        time.sleep(common.DIGEST_CACHE_RACY_SECONDS)
+
+        runs = []
+        for signer in signers:
+            for algorithm in args.digest_algorithms.split(","):
+                base_params = dict(type=common.TYPE_PLAYBOOK, keyless_signer_id="", public_key="", digest_algorithm=algorithm)
+                base_params.update(signer)
+                for workers in [int(w) for w in args.workers.split(",")]:
+                    for i in range(args.repeat):
+                        cache_dir = os.path.join(work_dir, "cache-{}-{}-{}-{}".format(signer["signature_type"], algorithm, workers, i))
+                        for cache_state, cache_arg in [("none", None), ("cold", cache_dir), ("warm", cache_dir)]:
+                            phases, cache_stats = bench_target(common, sign, verify, repo, workers, cache_arg, base_params)
+                            runs.append(dict(signature_type=signer["signature_type"], digest_algorithm=algorithm, workers=workers, repeat=i,
+                                             cache=cache_state, cache_stats=cache_stats, phases=phases))
+
+        report = dict(
+            created=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            host=dict(python=platform.python_version(), platform=platform.platform(), machine=platform.machine(), cpus=os.cpu_count()),
+            repo=repo_info,
+            generate=generate_time,
+            runs=runs,
+        )
+        output = json.dumps(report, indent=2)
+        if args.output == "-":
+            print(output)
+        else:
+            with open(args.output, "w") as f:
+                f.write(output + "\n")
+    finally:
+        if args.keep:
+            sys.stderr.write("kept {}\n".format(work_dir))
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
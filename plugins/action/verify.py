@@ -0,0 +1,167 @@
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import traceback
+
+from ansible.plugins.action import ActionBase
+from ansible.utils.vars import merge_hash
+import ansible_collections.playbook.integrity.plugins.module_utils.common as common
+from ansible_collections.playbook.integrity.plugins.module_utils.batch import run_targets
+from ansible_collections.playbook.integrity.plugins.module_utils.metrics import result_samples, write_metrics_file
+from ansible_collections.playbook.integrity.plugins.module_utils.verify import Verifier
+from ansible_collections.playbook.integrity.plugins.module_utils.verifyd import request_key
+from ansible_collections.playbook.integrity.plugins.modules.verify import module_args, required_one_of, mutually_exclusive
+
+
+RUN_ON_REMOTE = "remote"
+RUN_ON_CONTROLLER = "controller"
+
+# verdicts are shared between the worker processes of a play through files under the controller cache dir
+VERDICT_DIRNAME = "play-verdicts"
+VERDICT_MAX_AGE_SECONDS = 24 * 60 * 60
+
+
+class ActionModule(ActionBase):
+
+    _supports_check_mode = True
+
+    def run(self, tmp=None, task_vars=None):
+        result = super(ActionModule, self).run(tmp, task_vars)
+        del tmp
+
+        if self._task.args.get("run_on", RUN_ON_REMOTE) != RUN_ON_CONTROLLER:
+            return merge_hash(result, self._execute_module(task_vars=task_vars))
+
+        _, params = self.validate_argument_spec(
+            argument_spec=module_args,
+            required_one_of=required_one_of,
+            mutually_exclusive=mutually_exclusive,
+        )
+        result.update(changed=False, message='')
+        if self._play_context.check_mode:
+            return result
+
+        if params["targets"]:
+            verify_result = run_targets(params, params["targets"], self.verify_once, max_parallel=params["max_parallel_targets"])
+            verdicts = verify_result["results"]
+        else:
+            try:
+                verify_result = self.verify_once(params)
+            except Exception:
+                verify_result = {"failed": True}
+                verify_result["traceback"] = traceback.format_exc()
+            verify_result["target"] = params["target"]
+            verdicts = [verify_result]
+
+        # the connection is not thread-safe, so the hosts' digest files are compared after all targets are verified
+        if params["compare_remote_manifest"]:
+            for verdict in verdicts:
+                if verdict.get("failed", False):
+                    continue
+                verdict["remote_manifest"] = self.compare_remote_manifest(verdict["target"], verdict.get("manifest_sha256", ""), task_vars)
+                if not verdict["remote_manifest"]["match"]:
+                    verdict["failed"] = True
+            if params["targets"]:
+                failed_targets = [verdict["target"] for verdict in verdicts if verdict.get("failed", False)]
+                verify_result["failed"] = len(failed_targets) > 0
+                verify_result["summary"].update(succeeded=len(verdicts) - len(failed_targets), failed=len(failed_targets), failed_targets=failed_targets)
+
+        if params["metrics_file"]:
+            try:
+                write_metrics_file(params["metrics_file"], result_samples("verify", params, verify_result), metrics_format=params["metrics_format"])
+            except (OSError, ValueError) as e:
+                self._display.warning("failed to write the metrics file \"{}\"; {}".format(params["metrics_file"], e))
+
+        result['detail'] = verify_result
+        result['changed'] = True
+        if verify_result.get("failed", False) and params["action"] == "fail":
+            result['failed'] = True
+            result['msg'] = 'Verification failed'
+        return result
+
+    # runs the Verifier for `params["target"]` at most once per play and (params, HEAD commit, digest file) key.
+    # concurrent workers for the same key wait on a file lock, then read the verdict written by the first one.
+    def verify_once(self, params):
+        path = os.path.realpath(os.path.expanduser(params["target"]))
+        key, manifest_sha256 = self.verdict_key(path, params)
+        if params["paranoid"]:
+            verdict = Verifier(params).verify()
+            verdict["manifest_sha256"] = manifest_sha256
+            verdict["memoized"] = False
+            return verdict
+        verdict_dir = self.verdict_dir(params)
+        verdict_file = os.path.join(verdict_dir, "{}.json".format(key))
+        with open(verdict_file + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(verdict_file):
+                with open(verdict_file, "r") as f:
+                    verdict = json.load(f)
+                verdict["memoized"] = True
+                return verdict
+            verdict = Verifier(params).verify()
+            verdict["manifest_sha256"] = manifest_sha256
+            fd, tmp_file = tempfile.mkstemp(dir=verdict_dir, prefix=".verdict.")
+            with os.fdopen(fd, "w") as f:
+                json.dump(verdict, f)
+            os.replace(tmp_file, verdict_file)
+        verdict["memoized"] = False
+        return verdict
+
+    def verdict_key(self, path, params):
+        head = ""
+        result = common.run_command(["git", "rev-parse", "--verify", "-q", "HEAD"], cwd=path)
+        if result["returncode"] == 0:
+            head = result["stdout"].strip()
+        manifest_sha256 = ""
+        digest_file = os.path.join(path, common.DIGEST_FILENAME)
+        if os.path.exists(digest_file):
+            manifest_sha256 = common.sha256_file(digest_file)
+        # every option takes part in the key, like in the verifier daemon, so a stricter task never reuses a looser verdict
+        key = [request_key(params), head, manifest_sha256]
+        return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest(), manifest_sha256
+
+    def verdict_dir(self, params):
+        base_dir = os.path.join(params["digest_cache_dir"] or common.default_cache_dir(), VERDICT_DIRNAME)
+        verdict_dir = os.path.join(base_dir, self.play_id())
+        if not os.path.isdir(verdict_dir):
+            os.makedirs(verdict_dir, mode=0o700, exist_ok=True)
+            # verdict dirs of earlier plays are no longer used
+            for name in os.listdir(base_dir):
+                old_dir = os.path.join(base_dir, name)
+                try:
+                    if name != os.path.basename(verdict_dir) and time.time() - os.stat(old_dir).st_mtime > VERDICT_MAX_AGE_SECONDS:
+                        shutil.rmtree(old_dir, ignore_errors=True)
+                except OSError:
+                    pass
+        return verdict_dir
+
+    # the play's uuid is the same in every worker process of the play
+    def play_id(self):
+        parent = self._task._parent
+        while parent is not None:
+            play = getattr(parent, "_play", None)
+            if play is not None:
+                return play._uuid
+            parent = getattr(parent, "_parent", None)
+        return "ppid-{}".format(os.getppid())
+
+    def compare_remote_manifest(self, target, manifest_sha256, task_vars):
+        remote_file = os.path.join(target, common.DIGEST_FILENAME)
+        stat = self._execute_module(
+            module_name="ansible.builtin.stat",
+            module_args=dict(path=remote_file, get_checksum=True, checksum_algorithm="sha256"),
+            task_vars=task_vars,
+        )
+        remote_sha256 = stat.get("stat", {}).get("checksum", "")
+        result = dict(path=remote_file, sha256=remote_sha256, match=remote_sha256 != "" and remote_sha256 == manifest_sha256)
+        if stat.get("failed", False):
+            result["msg"] = stat.get("msg", "")
+        return result
@@ -0,0 +1,87 @@
+import os
+import posixpath
+import tarfile
+
+
+ARCHIVE_READ_SIZE = 1024 * 1024
+# tarfile keeps every member it has read in stream mode; they are dropped every so many members
+ARCHIVE_MEMBERS_KEPT = 1000
+
+
+def is_archive(path):
+    return os.path.isfile(path) and tarfile.is_tarfile(path)
+
+
+# the member name as a relative "/"-separated path, or None for names that escape the archive root
+def member_path(name):
+    path = posixpath.normpath(name)
+    if path.startswith("/") or path == ".." or path.startswith("../"):
+        return None
+    return "" if path == "." else path
+
+
+class ArchiveReader:
+    def __init__(self, path, new_hash, keep=None, keep_dir=None, metrics=None):
+        self.path = path
+        self.new_hash = new_hash
+        self.keep = keep
+        self.keep_dir = keep_dir
+        self.metrics = metrics
+        self.digests = {}
+        self.kept = []
+        self.errors = []
+        self.bytes_read = 0
+
+    # reads the archive once, front to back, hashing each regular file with every algorithm in `algorithms`.
+    # the members for which `keep(path)` is true (the digest file and signatures) are also copied to `keep_dir`.
+    # `on_kept(path, fpath)` may return a shorter list of algorithms for the members that follow.
+    # returns {path: {algorithm: hexdigest}}; symlinks, directories and special files are skipped.
+    def read(self, algorithms, on_kept=None):
+        buf = bytearray(ARCHIVE_READ_SIZE)
+        view = memoryview(buf)
+        with tarfile.open(self.path, mode="r|*") as tar:
+            for i, member in enumerate(tar):
+                if i % ARCHIVE_MEMBERS_KEPT == 0:
+                    tar.members = []
+                path = member_path(member.name)
+                if path is None:
+                    self.errors.append("{}: the member name \"{}\" is outside of the archive".format(self.path, member.name))
+                    continue
+                if member.islnk():
+                    # a hard link has no content of its own; it is the same file as an earlier member
+                    linked = self.digests.get(member_path(member.linkname) or "")
+                    if linked is None:
+                        self.errors.append("{}: the hard link \"{}\" points to a missing member".format(self.path, member.name))
+                    else:
+                        self.digests[path] = dict(linked)
+                    continue
+                if not member.isfile():
+                    continue
+                hashes = [(algorithm, self.new_hash(algorithm)) for algorithm in algorithms]
+                out = None
+                kept = self.keep is not None and self.keep(path)
+                if kept:
+                    fpath = os.path.join(self.keep_dir, path)
+                    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+                    out = open(fpath, "wb")
+                f = tar.extractfile(member)
+                try:
+                    while True:
+                        n = f.readinto(buf)
+                        if not n:
+                            break
+                        for _, h in hashes:
+                            h.update(view[:n])
+                        if out is not None:
+                            out.write(view[:n])
+                        self.bytes_read += n
+                finally:
+                    f.close()
+                    if out is not None:
+                        out.close()
+                self.digests[path] = dict((algorithm, h.hexdigest()) for algorithm, h in hashes)
+                if kept:
+                    self.kept.append(path)
+                    if on_kept is not None:
+                        algorithms = on_kept(path, fpath) or algorithms
+        return self.digests
@@ -0,0 +1,40 @@
+import concurrent.futures
+import traceback
+
+
+DEFAULT_MAX_PARALLEL_TARGETS = 4
+
+
+# runs `func(params)` once per target with bounded parallelism.
+# `func` is e.g. `lambda p: Signer(p).sign()`; the per-target params are a copy of `params` with "target" replaced.
+def run_targets(params, targets, func, max_parallel=DEFAULT_MAX_PARALLEL_TARGETS):
+    if not max_parallel or max_parallel < 0:
+        max_parallel = DEFAULT_MAX_PARALLEL_TARGETS
+    max_parallel = min(max_parallel, max(1, len(targets)))
+
+    def run_one(target):
+        target_params = dict(params)
+        target_params["target"] = target
+        try:
+            result = func(target_params)
+        except Exception:
+            result = {"failed": True}
+            result["traceback"] = traceback.format_exc()
+        result["target"] = target
+        return result
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        results = list(executor.map(run_one, targets))
+
+    failed_targets = [r["target"] for r in results if r.get("failed", False)]
+    summary = dict(
+        total=len(results),
+        succeeded=len(results) - len(failed_targets),
+        failed=len(failed_targets),
+        failed_targets=failed_targets,
+    )
+    return dict(
+        failed=len(failed_targets) > 0,
+        summary=summary,
+        results=results,
+    )
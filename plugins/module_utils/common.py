@@ -1,8 +1,34 @@
 
 from hmac import digest
+import collections
+import concurrent.futures
+import fcntl
+import functools
+import hashlib
+import json
+import mmap
 import os
 import platform
+import posixpath
+import re
+import shlex
+import shutil
 import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+import ansible_collections.playbook.integrity.plugins.module_utils.archive as archive
+import ansible_collections.playbook.integrity.plugins.module_utils.dirwalk as dirwalk
+import ansible_collections.playbook.integrity.plugins.module_utils.manifest as manifest
+import ansible_collections.playbook.integrity.plugins.module_utils.merkle as merkle
+import ansible_collections.playbook.integrity.plugins.module_utils.metrics as metrics_util
+
+try:
+    import blake3
+    HAS_BLAKE3 = True
+except ImportError:
+    HAS_BLAKE3 = False
 
 
 TYPE_PLAYBOOK = "playbook"
@@ -13,113 +39,1091 @@ SIGNATURE_TYPE_SIGSTORE_KEYLESS = "sigstore_keyless"
 
 SIGSTORE_TARGET_TYPE_FILE = "file"
 
+SCM_TYPE_AUTO = "auto"
 SCM_TYPE_GIT = "git"
+SCM_TYPE_DIR = "dir"
+SCM_TYPE_ARCHIVE = "archive"
 
 DIGEST_FILENAME = "sha256sum.txt"
 SIGNATURE_FILENAME_GPG = "sha256sum.txt.sig"
 SIGNATURE_FILENAME_SIGSTORE = "sha256sum.txt.sig"
 
+# with "signers", every signer writes its own signature "sha256sum.txt.<name>.sig"
+SIGNER_NAME_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]*$")
+# the digest file and its signatures and bundles, e.g. "sha256sum.txt.sig" or "sha256sum.txt.release.bundle"
+MANIFEST_NAME_PATTERN = re.compile(r"^sha256sum\.txt(\.([A-Za-z0-9][A-Za-z0-9_.-]*\.)?(sig|bundle))?$")
+
 CHECKSUM_OK_IDENTIFIER = ": OK"
-TMP_GNUPG_HOME_DIR = "/tmp/gpghome"
 TMP_COSIGN_PATH = "/tmp/cosign"
+# per-invocation scratch directories are created on tmpfs when it is available
+SCRATCH_BASE_DIRS = ["/dev/shm"]
+SCRATCH_DIR_PREFIX = "playbook-integrity-"
+COSIGN_VERSION = "v1.4.1"
+COSIGN_RECORD_FILENAME = "cosign.json"
+
+HASH_READ_SIZE = 1024 * 1024
+HASH_MMAP_THRESHOLD = 64 * 1024 * 1024
+# files this large are hashed one per task, largest first; smaller files are hashed in batches
+HASH_LARGE_FILE_SIZE = 8 * 1024 * 1024
+HASH_BATCH_MAX_FILES = 64
+HASH_BATCH_MAX_BYTES = 4 * 1024 * 1024
+
+HASH_POOL_THREAD = "thread"
+HASH_POOL_PROCESS = "process"
+
+DIGEST_MODE_SHA256 = "sha256"
+DIGEST_MODE_GIT_OBJECT = "git-object"
+
+# content digests of the "sha256" mode. the algorithm is recorded as the "digest" header of the digest file,
+# and a digest file without it is sha256. blake2b is 512-bit; blake3 needs the blake3 package.
+DIGEST_ALGORITHM_SHA256 = "sha256"
+DIGEST_ALGORITHM_BLAKE2B = "blake2b"
+DIGEST_ALGORITHM_BLAKE3 = "blake3"
+DIGEST_ALGORITHMS = [DIGEST_ALGORITHM_SHA256, DIGEST_ALGORITHM_BLAKE2B, DIGEST_ALGORITHM_BLAKE3]
+
+DIGEST_CACHE_FILENAME = "digest-cache.json"
+DIGEST_CACHE_MAX_ENTRIES = 200000
+# files modified this recently are not cached, since a later change could keep the same mtime
+DIGEST_CACHE_RACY_SECONDS = 2
+
+GIT_MODE_SYMLINK = "120000"
+GIT_MODE_GITLINK = "160000"
+# the repository's own config must not make git skip looking at the working tree
+GIT_WORKTREE_CONFIG = ["-c", "core.fsmonitor=false", "-c", "core.checkStat=default", "-c", "core.trustctime=true", "-c", "core.ignoreStat=false"]
+# "git ls-files -v -t" tags of index entries whose working tree file git does not compare:
+# lowercase for assume-unchanged, "S" for skip-worktree
+GIT_TAG_SKIP_WORKTREE = "S"
+
+# entries of each kind listed in a digest check failure; the counts are always complete
+DIFF_MAX_REPORTED = 1000
+GIT_OBJECT_TYPE_BLOB = "blob"
+
+# with lfs pointers, files tracked by git-lfs are recorded as the sha256 of their lfs pointer,
+# whether the working tree holds the pointer or the materialized content
+LFS_POINTER_VERSION = "https://git-lfs.github.com/spec/v1"
+LFS_POINTER_MAX_SIZE = 1024
+LFS_FILTER = "lfs"
+MANIFEST_HEADER_LFS = "lfs"
+MANIFEST_LFS_POINTER = "pointer"
+
+# plain directories are signed with the ignore patterns recorded in the header, so the verifier lists the same files
+MANIFEST_HEADER_IGNORE = "ignore"
+DIR_ALWAYS_IGNORED = [".git/"]
+
+
+def new_hash(algorithm=DIGEST_ALGORITHM_SHA256):
+    if algorithm == DIGEST_ALGORITHM_SHA256:
+        return hashlib.sha256()
+    elif algorithm == DIGEST_ALGORITHM_BLAKE2B:
+        return hashlib.blake2b()
+    elif algorithm == DIGEST_ALGORITHM_BLAKE3:
+        if not HAS_BLAKE3:
+            raise ValueError("the digest algorithm \"{}\" requires the blake3 python package".format(algorithm))
+        return blake3.blake3()
+    raise ValueError("this digest algorithm is not supported: {}".format(algorithm))
+
+
+def sha256_file(fpath, buf=None):
+    return hash_file(fpath, buf=buf)
+
+
+# `buf` is a read buffer that callers hashing many files can reuse
+def hash_file(fpath, algorithm=DIGEST_ALGORITHM_SHA256, buf=None):
+    h = new_hash(algorithm)
+    with open(fpath, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= HASH_MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if hasattr(m, "madvise"):
+                    m.madvise(mmap.MADV_SEQUENTIAL)
+                h.update(m)
+        else:
+            if buf is None:
+                buf = bytearray(min(HASH_READ_SIZE, size + 1))
+            view = memoryview(buf)
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                h.update(view[:n])
+    return h.hexdigest()
+
+
+def lfs_pointer(oid, size):
+    return "version {}\noid sha256:{}\nsize {}\n".format(LFS_POINTER_VERSION, oid, size).encode("utf-8")
+
+
+# digest of the lfs pointer of a file; a pointer file is hashed as is, and for materialized content
+# the pointer is rebuilt from the content, so that both give the same digest. the pointer oid is always sha256.
+def lfs_pointer_hash_file(fpath, algorithm=DIGEST_ALGORITHM_SHA256, buf=None):
+    with open(fpath, "rb") as f:
+        head = f.read(LFS_POINTER_MAX_SIZE + 1)
+        size = os.fstat(f.fileno()).st_size
+    h = new_hash(algorithm)
+    if len(head) <= LFS_POINTER_MAX_SIZE and head.startswith("version {}\n".format(LFS_POINTER_VERSION).encode("utf-8")):
+        h.update(head)
+    else:
+        h.update(lfs_pointer(sha256_file(fpath, buf=buf), size))
+    return h.hexdigest()
+
+
+def _hash_file_or_error(fpath, lfs=False, algorithm=DIGEST_ALGORITHM_SHA256, buf=None):
+    try:
+        if lfs:
+            return lfs_pointer_hash_file(fpath, algorithm=algorithm, buf=buf), None
+        return hash_file(fpath, algorithm=algorithm, buf=buf), None
+    except OSError as e:
+        return None, "{}sum: {}: {}".format(algorithm, fpath, e.strerror)
+
+
+# hashes a batch of (fpath, lfs) with one read buffer
+def _hash_batch(items, algorithm=DIGEST_ALGORITHM_SHA256, cancelled=None):
+    buf = bytearray(HASH_READ_SIZE)
+    outputs = []
+    for fpath, lfs in items:
+        if cancelled is not None and cancelled.is_set():
+            outputs.append((None, "{}sum: {}: cancelled".format(algorithm, fpath)))
+            continue
+        outputs.append(_hash_file_or_error(fpath, lfs=lfs, algorithm=algorithm, buf=buf))
+    return outputs
+
+
+# groups file indices into hashing tasks: large files alone and largest first, so that one big file
+# does not start last and stall the pool, then the small files in batches of similar total size
+def schedule_by_size(sizes):
+    order = sorted(range(len(sizes)), key=lambda i: sizes[i], reverse=True)
+    tasks = []
+    batch = []
+    batch_bytes = 0
+    for i in order:
+        if sizes[i] >= HASH_LARGE_FILE_SIZE:
+            tasks.append([i])
+            continue
+        batch.append(i)
+        batch_bytes += sizes[i]
+        if len(batch) >= HASH_BATCH_MAX_FILES or batch_bytes >= HASH_BATCH_MAX_BYTES:
+            tasks.append(batch)
+            batch = []
+            batch_bytes = 0
+    if len(batch) > 0:
+        tasks.append(batch)
+    return tasks
+
+
+# a private scratch directory for one sign/verify invocation, created on first use and removed on exit.
+# nothing in it is shared with other invocations, so concurrent forks on the same host never collide.
+class Workspace:
+    def __init__(self):
+        self.dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.cleanup()
+
+    def _base_dir(self):
+        for base in SCRATCH_BASE_DIRS:
+            if os.path.isdir(base) and os.access(base, os.W_OK | os.X_OK):
+                return base
+        return None
+
+    def path(self, name):
+        if self.dir is None:
+            self.dir = tempfile.mkdtemp(prefix=SCRATCH_DIR_PREFIX, dir=self._base_dir())
+        return os.path.join(self.dir, name)
+
+    def cleanup(self):
+        if self.dir is not None:
+            shutil.rmtree(self.dir, ignore_errors=True)
+            self.dir = None
+
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME", "") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "playbook-integrity")
+
+
+# on-disk sha256 cache keyed by (path, size, mtime_ns, inode, ctime_ns) with LRU eviction.
+# writers merge their updates into the latest file content under an exclusive lock.
+class DigestCache:
+    def __init__(self, cache_dir="", max_entries=DIGEST_CACHE_MAX_ENTRIES):
+        self.cache_dir = cache_dir or default_cache_dir()
+        if self.cache_dir.startswith("~/"):
+            self.cache_dir = os.path.expanduser(self.cache_dir)
+        self.cache_file = os.path.join(self.cache_dir, DIGEST_CACHE_FILENAME)
+        self.lock_file = "{}.lock".format(self.cache_file)
+        self.max_entries = max_entries
+        self.entries = None
+        self.updates = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _open_lock(self, operation):
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, operation)
+        return fd
+
+    def _read(self):
+        entries = collections.OrderedDict()
+        try:
+            with open(self.cache_file, "r") as f:
+                for item in json.load(f):
+                    entries[item[0]] = item[1:]
+        except (OSError, ValueError, TypeError, IndexError):
+            pass
+        return entries
+
+    def load(self):
+        fd = self._open_lock(fcntl.LOCK_SH)
+        try:
+            self.entries = self._read()
+        finally:
+            os.close(fd)
+
+    def lookup(self, fpath, st):
+        if self.entries is None:
+            self.load()
+        entry = self.entries.get(fpath)
+        key = [st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns]
+        if entry is not None and entry[:4] == key:
+            self.hits += 1
+            self.updates[fpath] = entry
+            self.updates.move_to_end(fpath)
+            return entry[4]
+        self.misses += 1
+        return None
+
+    def store(self, fpath, st, hexdigest):
+        racy_ns = time.time_ns() - DIGEST_CACHE_RACY_SECONDS * 1000000000
+        if st.st_mtime_ns >= racy_ns or st.st_ctime_ns >= racy_ns:
+            return
+        entry = [st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns, hexdigest]
+        self.updates[fpath] = entry
+        self.updates.move_to_end(fpath)
+
+    def save(self):
+        if len(self.updates) == 0:
+            return
+        fd = self._open_lock(fcntl.LOCK_EX)
+        try:
+            entries = self._read()
+            for fpath, entry in self.updates.items():
+                entries[fpath] = entry
+                entries.move_to_end(fpath)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            tmp_fd, tmp_file = tempfile.mkstemp(dir=self.cache_dir, prefix=".{}.".format(DIGEST_CACHE_FILENAME))
+            with os.fdopen(tmp_fd, "w") as f:
+                json.dump([[fpath] + entry for fpath, entry in entries.items()], f, separators=(",", ":"))
+            os.replace(tmp_file, self.cache_file)
+            self.entries = entries
+            self.updates = collections.OrderedDict()
+        finally:
+            os.close(fd)
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses)
+
+
+class HashEngine:
+    def __init__(self, workers=0, pool=HASH_POOL_THREAD, cache=None, metrics=None, algorithm=DIGEST_ALGORITHM_SHA256):
+        if not workers or workers < 0:
+            workers = os.cpu_count() or 1
+        if pool not in [HASH_POOL_THREAD, HASH_POOL_PROCESS]:
+            raise ValueError("this hash pool type is not supported: {}".format(pool))
+        if algorithm not in DIGEST_ALGORITHMS:
+            raise ValueError("this digest algorithm is not supported: {}".format(algorithm))
+        self.algorithm = algorithm
+        self.workers = workers
+        self.pool = pool
+        self.cache = cache
+        self.metrics = metrics or metrics_util.Metrics()
+        self.cancelled = threading.Event()
+
+    # files not yet started are skipped once cancelled; a process pool finishes the files already submitted
+    def cancel(self):
+        self.cancelled.set()
+
+    def _hash_batch_unless_cancelled(self, items):
+        return _hash_batch(items, algorithm=self.algorithm, cancelled=self.cancelled)
+
+    def cache_stats(self):
+        if self.cache is None:
+            return dict(enabled=False, hits=0, misses=0)
+        return dict(enabled=True, **self.cache.stats())
+
+    # returns (fname, hexdigest or None, error or None) in the same order as `fnames`.
+    # files in `lfs_fnames` are hashed as their lfs pointer.
+    def hash_files(self, root, fnames, lfs_fnames=None):
+        with self.metrics.phase(metrics_util.PHASE_HASH):
+            fpaths = [os.path.abspath(os.path.join(root, fname)) for fname in fnames]
+            lfs = [lfs_fnames is not None and fname in lfs_fnames for fname in fnames]
+            # pointer digests and other algorithms are cached apart from the sha256 content digests of the same path
+            cache_keys = ["{}:{}".format(LFS_FILTER, fpath) if lfs[i] else fpath for i, fpath in enumerate(fpaths)]
+            if self.algorithm != DIGEST_ALGORITHM_SHA256:
+                cache_keys = ["{}:{}".format(self.algorithm, key) for key in cache_keys]
+            outputs = [None] * len(fpaths)
+            stats = {}
+            todo = []
+            for i, fpath in enumerate(fpaths):
+                try:
+                    st = os.stat(fpath)
+                except OSError:
+                    st = None
+                if st is not None:
+                    if self.cache is not None:
+                        hexdigest = self.cache.lookup(cache_keys[i], st)
+                        if hexdigest is not None:
+                            outputs[i] = (hexdigest, None)
+                            continue
+                    stats[i] = st
+                todo.append(i)
+
+            hashed_bytes = 0
+            sizes = [stats[i].st_size if i in stats else 0 for i in todo]
+            for i, out in zip(todo, self._hash_paths([(fpaths[i], lfs[i]) for i in todo], sizes)):
+                outputs[i] = out
+                if i in stats and out[0] is not None:
+                    hashed_bytes += stats[i].st_size
+                    if self.cache is not None:
+                        self.cache.store(cache_keys[i], stats[i], out[0])
+            if self.cache is not None:
+                self.cache.save()
+            self.metrics.add(metrics_util.COUNTER_FILES_HASHED, len(todo))
+            self.metrics.add(metrics_util.COUNTER_FILES_CACHED, len(fpaths) - len(todo))
+            self.metrics.add(metrics_util.COUNTER_BYTES_HASHED, hashed_bytes)
+        return [(fname, out[0], out[1]) for fname, out in zip(fnames, outputs)]
+
+    # `items` is a list of (fpath, lfs); returns (hexdigest or None, error or None) in the same order
+    def _hash_paths(self, items, sizes):
+        if self.workers == 1 or len(items) <= 1:
+            return self._hash_batch_unless_cancelled(items)
+        tasks = schedule_by_size(sizes)
+        batches = [[items[i] for i in task] for task in tasks]
+        if self.pool == HASH_POOL_PROCESS:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as executor:
+                batch_outputs = list(executor.map(functools.partial(_hash_batch, algorithm=self.algorithm), batches))
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+                batch_outputs = list(executor.map(self._hash_batch_unless_cancelled, batches))
+        outputs = [None] * len(items)
+        for task, batch_output in zip(tasks, batch_outputs):
+            for i, out in zip(task, batch_output):
+                outputs[i] = out
+        return outputs
+
 
 class Digester:
-    def __init__(self, path):
+    def __init__(self, path, workers=0, digest_mode=DIGEST_MODE_SHA256, cache=None, merkle=False, metrics=None, lfs_pointers=False,
+                 max_reported=DIFF_MAX_REPORTED, scm_type=SCM_TYPE_AUTO, ignore=None, digest_algorithm="", hash_pool=HASH_POOL_THREAD):
         self.path = path
         if path.startswith("~/"):
             self.path = os.path.expanduser(path)
-        self.type = self.get_scm_type(path)
+        self.metrics = metrics or metrics_util.Metrics()
+        # the HEAD commit, "" without one; resolved with the SCM type when it is detected
+        self.head = None
+        if scm_type not in [SCM_TYPE_AUTO, SCM_TYPE_GIT, SCM_TYPE_DIR, SCM_TYPE_ARCHIVE]:
+            raise ValueError("this SCM type is not supported: {}".format(scm_type))
+        self.type = scm_type if scm_type != SCM_TYPE_AUTO else self.get_scm_type(self.path)
+        self.ignore = list(ignore or [])
+        # the algorithm of generated digest files; check() takes it from the digest file and, if it is set,
+        # requires the digest file to use it
+        if digest_algorithm and digest_algorithm not in DIGEST_ALGORITHMS:
+            raise ValueError("this digest algorithm is not supported: {}".format(digest_algorithm))
+        self.digest_algorithm = digest_algorithm
+        self.hash_engine = HashEngine(workers=workers, pool=hash_pool, cache=cache, metrics=self.metrics, algorithm=digest_algorithm or DIGEST_ALGORITHM_SHA256)
+        if digest_mode not in [DIGEST_MODE_SHA256, DIGEST_MODE_GIT_OBJECT]:
+            raise ValueError("this digest mode is not supported: {}".format(digest_mode))
+        self.digest_mode = digest_mode
+        self.merkle = merkle
+        self.lfs_pointers = lfs_pointers
+        self.max_reported = max_reported
+        self.git_object_reader = None
+
+    # the HEAD commit of a git target, or "" when there is none
+    def head_commit(self):
+        if self.head is None:
+            if self.type != SCM_TYPE_GIT:
+                self.head = ""
+            else:
+                result = run_command(["git", "rev-parse", "--verify", "-q", "HEAD"], cwd=self.path, metrics=self.metrics)
+                self.head = result["stdout"].strip() if result["returncode"] == 0 else ""
+        return self.head
+
+    def git_objects(self):
+        if self.git_object_reader is None:
+            self.git_object_reader = GitObjectReader(self.path, metrics=self.metrics)
+        return self.git_object_reader
+
+    def cancel(self):
+        self.hash_engine.cancel()
 
-    # TODO: implement this
+    def close(self):
+        if self.git_object_reader is not None:
+            self.git_object_reader.close()
+            self.git_object_reader = None
+
+    # anything that is not a git work tree, e.g. a project synced from an archive, is signed as a plain directory
     def get_scm_type(self, path):
-        return SCM_TYPE_GIT
+        if os.path.isfile(path):
+            return SCM_TYPE_ARCHIVE
+        if not os.path.isdir(path):
+            raise ValueError("the target is neither a directory nor an archive: {}".format(path))
+        # only the top of a work tree is signed as git; a subdirectory of an enclosing work tree, which may not
+        # be tracked at all, is walked as a plain directory. HEAD is resolved in the same call; in a repository
+        # without commits it fails after printing the other two lines.
+        result = run_command(["git", "rev-parse", "--is-inside-work-tree", "--show-prefix", "HEAD"], cwd=path, metrics=self.metrics)
+        lines = result["stdout"].split("\n")
+        if lines[:2] == ["true", ""]:
+            self.head = lines[2].strip() if result["returncode"] == 0 and len(lines) > 2 else ""
+            return SCM_TYPE_GIT
+        self.head = ""
+        return SCM_TYPE_DIR
+
+    def hash_files(self, fnames, lfs=False):
+        lfs_fnames = self.git_lfs_files(fnames) if lfs and len(fnames) > 0 else None
+        return self.hash_engine.hash_files(self.path, fnames, lfs_fnames=lfs_fnames)
+
+    # the files among `fnames` whose "filter" attribute is lfs
+    def git_lfs_files(self, fnames):
+        result = run_command(["git", "check-attr", "-z", "--stdin", "filter"], cwd=self.path,
+                             input="".join(["{}\0".format(fname) for fname in fnames]), metrics=self.metrics)
+        if result["returncode"] != 0:
+            raise ValueError("failed to read the git attributes in {}; {}".format(self.path, result["stderr"]))
+        # -z output is "<path>\0<attribute>\0<value>\0" for every path
+        entries = result["stdout"].split("\0")
+        return set([entries[i] for i in range(0, len(entries) - 2, 3) if entries[i + 2] == LFS_FILTER])
+
+    # the header of a content digest file, or None when it is plain sha256sum output
+    def content_header(self, ignore=None):
+        header = {manifest.MANIFEST_HEADER_VERSION: manifest.MANIFEST_VERSION, manifest.MANIFEST_HEADER_DIGEST: self.hash_engine.algorithm}
+        if self.lfs_pointers:
+            header[MANIFEST_HEADER_LFS] = MANIFEST_LFS_POINTER
+        if ignore:
+            header[MANIFEST_HEADER_IGNORE] = json.dumps(ignore)
+        if len(header) == 2 and self.hash_engine.algorithm == DIGEST_ALGORITHM_SHA256:
+            return None
+        return header
 
-    def gen(self, filename=DIGEST_FILENAME):
+    def gen(self, filename=DIGEST_FILENAME, incremental=False):
         result = None
-        if self.type == SCM_TYPE_GIT:
+        if self.type == SCM_TYPE_GIT and self.digest_mode == DIGEST_MODE_GIT_OBJECT:
+            result = self.gen_git_object(filename=filename)
+        elif self.type == SCM_TYPE_GIT and incremental:
+            result = self.gen_git_incremental(filename=filename)
+        elif self.type == SCM_TYPE_GIT:
             result = self.gen_git(filename=filename)
+        elif self.type == SCM_TYPE_DIR and self.digest_mode == DIGEST_MODE_GIT_OBJECT:
+            raise ValueError("digest mode \"{}\" requires a git work tree, but {} is a plain directory".format(DIGEST_MODE_GIT_OBJECT, self.path))
+        elif self.type == SCM_TYPE_DIR:
+            # without commits to compare, a plain directory is always hashed in full
+            result = self.gen_dir(filename=filename)
+        elif self.type == SCM_TYPE_ARCHIVE:
+            raise ValueError("archives cannot be signed; sign the directory before packing it: {}".format(self.path))
         else:
             raise ValueError("this SCM type is not supported: {}".format(self.type))
         return result
     
-    def check(self):
-        result = self.filename_check()
-        if result["returncode"] != 0:
-            return result
-        result = self.digest_check()
-        return result
+    def list_files(self):
+        if self.type == SCM_TYPE_GIT:
+            return self.list_git_files()
+        elif self.type == SCM_TYPE_DIR:
+            return self.list_dir_files()
+        raise ValueError("this SCM type is not supported: {}".format(self.type))
 
-    def filename_check(self):
+    # single pass: every tracked file is hashed at most once and compared to the signed digest file in memory.
+    # with `paths`, only the files under those paths are checked against the merkle tree file.
+    def check(self, paths=None):
+        if self.type == SCM_TYPE_ARCHIVE:
+            return self.check_archive(paths=paths)
         digest_file = os.path.join(self.path, DIGEST_FILENAME)
         if not os.path.exists(digest_file):
             return dict(
                 returncode=1,
                 stdout="",
-                stderr="No such file or directory: {}".format(digest_file)
+                stderr="No such file or directory: {}".format(digest_file),
+                added=[],
+                removed=[],
+                modified=[],
+            )
+        header = manifest.read_header(digest_file)
+        digest_mode = header.get(manifest.MANIFEST_HEADER_DIGEST, DIGEST_ALGORITHM_SHA256)
+        lfs = header.get(MANIFEST_HEADER_LFS) == MANIFEST_LFS_POINTER
+        if self.digest_algorithm and digest_mode != self.digest_algorithm:
+            return dict(
+                returncode=1,
+                stdout="",
+                stderr="the digest file uses \"{}\" digests, but \"{}\" is required".format(digest_mode, self.digest_algorithm),
+                added=[],
+                removed=[],
+                modified=[],
             )
+        if self.type == SCM_TYPE_DIR:
+            self.ignore = json.loads(header.get(MANIFEST_HEADER_IGNORE) or "[]")
 
-        tmp_digest_file = os.path.join("/tmp/", DIGEST_FILENAME)
-        result = self.gen(filename=tmp_digest_file)
-        if result["returncode"] != 0:
-            result["stderr"] = "failed to get the current file & digest list.\n\n{}".format(result["stderr"])
-        signed_fnames = self.digest_file_to_filename_set(digest_file)
-        current_fnames = self.digest_file_to_filename_set(tmp_digest_file)
-        if signed_fnames != current_fnames:
-            added = current_fnames - signed_fnames if len(current_fnames - signed_fnames) > 0 else None
-            removed = signed_fnames - current_fnames if len(signed_fnames - current_fnames) > 0 else None
-            result = dict(
+        prefixes = None
+        if paths:
+            prefixes = [normalize_path(path) for path in paths]
+            result, signed_items = self.signed_subtrees(header, prefixes)
+            if result["returncode"] != 0:
+                return result
+        else:
+            signed_items = manifest.Manifest.load(digest_file).items()
+
+        hashed = None
+        if digest_mode == DIGEST_MODE_GIT_OBJECT:
+            result, hashed = self.git_object_digests()
+            if result["returncode"] != 0:
+                result["stderr"] = "failed to get the current git object list.\n\n{}".format(result["stderr"])
+                return result
+            fnames = [fname for fname, _, _ in hashed]
+        elif digest_mode in DIGEST_ALGORITHMS:
+            # fails before listing if the algorithm is not available on this host
+            new_hash(digest_mode)
+            self.hash_engine.algorithm = digest_mode
+            result, fnames = self.list_files()
+            if result["returncode"] != 0:
+                result["stderr"] = "failed to get the current file list.\n\n{}".format(result["stderr"])
+                return result
+        else:
+            raise ValueError("this digest mode is not supported: {}".format(digest_mode))
+        if prefixes is not None:
+            fnames = [fname for fname in fnames if is_under(fname, prefixes)]
+
+        added = []
+        removed = []
+        signed_common = []
+        with self.metrics.phase(metrics_util.PHASE_COMPARE):
+            current = ((fname, True) for fname in sorted(fnames))
+            for fname, signed_digest, present in manifest.merge_join(signed_items, current):
+                if signed_digest is None:
+                    added.append(fname)
+                elif present is None:
+                    removed.append(fname)
+                else:
+                    signed_common.append((fname, signed_digest))
+
+        # only the files that are both tracked and signed need their current digest
+        if hashed is None:
+            hashed = self.hash_files([fname for fname, _ in signed_common], lfs=lfs)
+        else:
+            current_digests = {fname: (hexdigest, err) for fname, hexdigest, err in hashed}
+            hashed = [(fname,) + current_digests[fname] for fname, _ in signed_common]
+
+        modified = []
+        errors = []
+        with self.metrics.phase(metrics_util.PHASE_COMPARE):
+            for (fname, hexdigest, err), (_, signed_digest) in zip(hashed, signed_common):
+                if err is not None:
+                    errors.append(err)
+                    modified.append(fname)
+                elif bytes.fromhex(hexdigest) != signed_digest:
+                    modified.append(fname)
+
+        result = dict(
+            returncode=0,
+            stdout="{} files checked".format(len(signed_common)),
+            stderr="",
+            added=added,
+            removed=removed,
+            modified=modified,
+            cache=self.hash_engine.cache_stats(),
+        )
+        if prefixes is not None:
+            result["paths"] = prefixes
+        if added or removed or modified:
+            result["returncode"] = 1
+            result.update(self.difference_report(added, removed, modified, errors))
+        return result
+
+    # an archive is read once from the front without extracting it, and every regular file is hashed as it streams by.
+    # only the digest file and its signatures are copied to `keep_dir`, where the signature can be verified.
+    # the root of the signed content is the shallowest directory in the archive that holds a digest file.
+    def check_archive(self, paths=None, keep_dir=None):
+        remove_dir = keep_dir is None
+        if keep_dir is None:
+            keep_dir = tempfile.mkdtemp(prefix=SCRATCH_DIR_PREFIX)
+        try:
+            return self._check_archive(paths, keep_dir)
+        except (tarfile.TarError, OSError) as e:
+            return dict(
                 returncode=1,
                 stdout="",
-                stderr="the following files are detected as differences.\nAdded: {}\nRemoved: {}".format(added, removed),
+                stderr="failed to read the archive {}; {}".format(self.path, e),
+                added=[],
+                removed=[],
+                modified=[],
             )
-            return result
+        finally:
+            if remove_dir:
+                shutil.rmtree(keep_dir, ignore_errors=True)
+
+    def _check_archive(self, paths, keep_dir):
+        # until a digest file tells the algorithm, files are hashed with every one that it may use
+        if self.digest_algorithm:
+            algorithms = [self.digest_algorithm]
+        else:
+            algorithms = [algorithm for algorithm in DIGEST_ALGORITHMS if algorithm != DIGEST_ALGORITHM_BLAKE3 or HAS_BLAKE3]
+        headers = {}
+
+        def on_kept(path, fpath):
+            if posixpath.basename(path) != DIGEST_FILENAME:
+                return None
+            headers[path] = manifest.read_header(fpath)
+            algorithm = headers[path].get(manifest.MANIFEST_HEADER_DIGEST, DIGEST_ALGORITHM_SHA256)
+            # e.g. "sha256sum.txt" or "project-1.0/sha256sum.txt"
+            if path.count("/") <= 1 and algorithm in algorithms:
+                return [algorithm]
+            return None
+
+        # the root is not known yet, so every member named like a digest file or signature is copied out; below the
+        # root they are still hashed and compared like any other file
+        reader = archive.ArchiveReader(self.path, new_hash, keep=lambda path: is_manifest_name(posixpath.basename(path)), keep_dir=keep_dir)
+        with self.metrics.phase(metrics_util.PHASE_HASH):
+            digests = reader.read(algorithms, on_kept=on_kept)
+        self.metrics.add(metrics_util.COUNTER_FILES_LISTED, len(digests))
+        self.metrics.add(metrics_util.COUNTER_FILES_HASHED, len(digests))
+        self.metrics.add(metrics_util.COUNTER_BYTES_HASHED, reader.bytes_read)
+
+        depths = sorted([(path.count("/"), path) for path in headers])
+        if len(depths) == 0:
+            return dict(returncode=1, stdout="", stderr="no {} found in the archive {}".format(DIGEST_FILENAME, self.path), added=[], removed=[], modified=[])
+        if len(depths) > 1 and depths[0][0] == depths[1][0]:
+            raise ValueError("the archive {} holds several digest files at the top: {}, {}".format(self.path, depths[0][1], depths[1][1]))
+        digest_path = depths[0][1]
+        root = posixpath.dirname(digest_path)
+        header = headers[digest_path]
+        digest_mode = header.get(manifest.MANIFEST_HEADER_DIGEST, DIGEST_ALGORITHM_SHA256)
+        if self.digest_algorithm and digest_mode != self.digest_algorithm:
+            return dict(
+                returncode=1,
+                stdout="",
+                stderr="the digest file uses \"{}\" digests, but \"{}\" is required".format(digest_mode, self.digest_algorithm),
+                added=[],
+                removed=[],
+                modified=[],
+            )
+        if digest_mode not in DIGEST_ALGORITHMS or header.get(MANIFEST_HEADER_LFS) == MANIFEST_LFS_POINTER:
+            raise ValueError("only content digest files can be checked in an archive, but {} is \"{}\"{}".format(
+                digest_path, digest_mode, " with lfs pointers" if header.get(MANIFEST_HEADER_LFS) else ""))
+        ignore = DIR_ALWAYS_IGNORED + json.loads(header.get(MANIFEST_HEADER_IGNORE) or "[]")
+        prefixes = [normalize_path(path) for path in paths] if paths else None
+
+        errors = list(reader.errors)
+        current = []
+        added = []
+        for path, file_digests in digests.items():
+            if root != "" and not path.startswith(root + "/"):
+                # content next to the signed root is not covered by the signature
+                added.append(path)
+                continue
+            fname = path[len(root) + 1:] if root != "" else path
+            if is_manifest_file(fname) or dirwalk.is_ignored_path(fname, ignore):
+                continue
+            if prefixes is not None and not is_under(fname, prefixes):
+                continue
+            current.append((fname, file_digests.get(digest_mode, "")))
+        current.sort()
+
+        signed = manifest.Manifest.load(os.path.join(keep_dir, digest_path))
+        signed_items = signed.items()
+        if prefixes is not None:
+            signed_items = ((fname, digest) for fname, digest in signed_items if is_under(fname, prefixes))
+        removed = []
+        modified = []
+        checked = 0
+        with self.metrics.phase(metrics_util.PHASE_COMPARE):
+            for fname, signed_digest, hexdigest in manifest.merge_join(signed_items, current):
+                if signed_digest is None:
+                    added.append(fname)
+                elif hexdigest is None:
+                    removed.append(fname)
+                elif hexdigest == "":
+                    # hashed before the digest file was read, with other algorithms only
+                    errors.append("{}: {} was not hashed with {}; set digest_algorithm to \"{}\"".format(self.path, fname, digest_mode, digest_mode))
+                    modified.append(fname)
+                else:
+                    checked += 1
+                    if bytes.fromhex(hexdigest) != signed_digest:
+                        modified.append(fname)
+
+        added.sort()
+        result = dict(
+            returncode=0,
+            stdout="{} files checked".format(checked),
+            stderr="",
+            added=added,
+            removed=removed,
+            modified=modified,
+            cache=self.hash_engine.cache_stats(),
+            archive=dict(path=self.path, root=root, digest_file=digest_path),
+        )
+        if prefixes is not None:
+            result["paths"] = prefixes
+        if added or removed or modified or errors:
+            result["returncode"] = 1
+            result.update(self.difference_report(added, removed, modified, errors))
         return result
 
-    def digest_file_to_filename_set(self, filename):
-        s = set()
-        lines = []
-        with open(filename, "r") as f:
-            lines = f.read()
-        for line in lines.splitlines():
-            items = line.split(" ")
-            fname = items[len(items)-1]
-            s.add(fname)
-        return s
-
-    def digest_check(self):
-        tmp_check_out = "/tmp/digest_check_output.txt"
-        cmd = "cd {}; sha256sum --check {} > {} 2>&1".format(self.path, DIGEST_FILENAME, tmp_check_out)
-        result = execute_command(cmd)
-        if result["returncode"] != 0:
-            check_out_str = ""
-            with open(tmp_check_out, "r") as f:
-                check_out_str = f.read()
-            err_str = result["stderr"]
-            for line in check_out_str.splitlines():
-                if CHECKSUM_OK_IDENTIFIER in line:
+    # at most `max_reported` entries of each list are reported (0 for all), plus the total counts
+    def difference_report(self, added, removed, modified, errors):
+        limit = self.max_reported if self.max_reported and self.max_reported > 0 else None
+        report = dict(
+            added=added[:limit],
+            removed=removed[:limit],
+            modified=modified[:limit],
+            differences=dict(added=len(added), removed=len(removed), modified=len(modified)),
+        )
+        lines = ["the following files are detected as differences."]
+        for key in ["added", "removed", "modified"]:
+            count = report["differences"][key]
+            items = report[key]
+            line = "{}: {}".format(key.capitalize(), items or None)
+            if count > len(items):
+                line = "{} ... and {} more".format(line, count - len(items))
+                report["truncated"] = True
+            lines.append(line)
+        lines += errors[:limit]
+        if limit is not None and len(errors) > limit:
+            lines.append("... and {} more errors".format(len(errors) - limit))
+        report["stderr"] = "".join(["{}\n".format(line) for line in lines])
+        return report
+
+    # returns the signed (fname, digest) entries under `prefixes`, sorted by name.
+    # each subtree is authenticated by recomputing the merkle root recorded in the signed digest file header.
+    def signed_subtrees(self, header, prefixes):
+        root = header.get(merkle.MANIFEST_HEADER_MERKLE_ROOT, "")
+        tree_file = os.path.join(self.path, merkle.MERKLE_FILENAME)
+        if root == "" or not os.path.exists(tree_file):
+            return dict(
+                returncode=1,
+                stdout="",
+                stderr="partial verification requires a merkle tree; sign the target with merkle enabled",
+            ), []
+        tree = merkle.MerkleTree.load(tree_file)
+        signed = {}
+        for prefix in prefixes:
+            try:
+                subtree_root = tree.root_from(prefix)
+            except ValueError as e:
+                return dict(returncode=1, stdout="", stderr=str(e)), []
+            if subtree_root != root:
+                return dict(
+                    returncode=1,
+                    stdout="",
+                    stderr="the merkle tree entries for \"{}\" do not match the signed merkle root".format(prefix or "."),
+                ), []
+            signed.update(tree.files_under(prefix))
+        items = [(fname, bytes.fromhex(signed[fname])) for fname in sorted(signed)]
+        return dict(returncode=0, stdout="", stderr=""), items
+
+    # writes the digest file, plus the merkle tree file with its root recorded in the digest file header
+    def write_manifest(self, filename, hashed, header=None):
+        hashed = list(hashed)
+        # an empty digest file would verify whatever the target holds
+        if len(hashed) == 0:
+            return ["no files to sign in {}; the digest file is not written".format(self.path)]
+        with self.metrics.phase(metrics_util.PHASE_WRITE):
+            return self._write_manifest(filename, hashed, header=header)
+
+    def _write_manifest(self, filename, hashed, header=None):
+        if not self.merkle:
+            return manifest.write_manifest(filename, hashed, header=header)
+        hashed = list(hashed)
+        if header is None:
+            digest = self.hash_engine.algorithm if self.digest_mode == DIGEST_MODE_SHA256 else self.digest_mode
+            header = {manifest.MANIFEST_HEADER_VERSION: manifest.MANIFEST_VERSION, manifest.MANIFEST_HEADER_DIGEST: digest}
+        dir_digests = merkle.build_dir_digests([(fname, hexdigest) for fname, hexdigest, err in hashed if err is None])
+        header = dict(header)
+        header[merkle.MANIFEST_HEADER_MERKLE_ROOT] = dir_digests[""]
+        tree_file = os.path.join(os.path.dirname(filename), merkle.MERKLE_FILENAME)
+        merkle.write_tree(tree_file, hashed, dir_digests, header=header)
+        return manifest.write_manifest(filename, hashed, header=header)
+
+    # symlinks and submodules are told apart by the mode and type in the ls-tree output, without a stat per file
+    def list_git_files(self):
+        with self.metrics.phase(metrics_util.PHASE_LIST):
+            stream = CommandStream(["git", "ls-tree", "-r", "-z", "HEAD"], cwd=self.path, sep=b"\0", metrics=self.metrics)
+            fnames = []
+            for entry in stream:
+                if entry == "":
                     continue
-                err_str = "{}{}\n".format(err_str, line)
-            result["stderr"] = err_str
-        return result
+                meta, _, fname = entry.partition("\t")
+                mode, otype, _ = meta.split(" ", 2)
+                if otype != GIT_OBJECT_TYPE_BLOB or mode == GIT_MODE_SYMLINK or is_manifest_file(fname):
+                    continue
+                fnames.append(fname)
+        if stream.result["returncode"] != 0:
+            return stream.result, []
+        self.metrics.add(metrics_util.COUNTER_FILES_LISTED, len(fnames))
+        return stream.result, fnames
+
+    # regular files of a plain directory, found with parallel scandir calls and no stat per file
+    def list_dir_files(self):
+        with self.metrics.phase(metrics_util.PHASE_LIST):
+            fnames, errors = dirwalk.walk_dir_files(self.path, ignore=DIR_ALWAYS_IGNORED + self.ignore, skip=is_manifest_file,
+                                                    workers=self.hash_engine.workers)
+        result = dict(
+            returncode=1 if len(errors) > 0 else 0,
+            stdout="",
+            stderr="".join(["{}\n".format(err) for err in errors]),
+            command="scandir {}".format(self.path),
+        )
+        if len(errors) > 0:
+            return result, []
+        self.metrics.add(metrics_util.COUNTER_FILES_LISTED, len(fnames))
+        return result, fnames
 
     def gen_git(self, filename=DIGEST_FILENAME):
-        cmd1 = "cd {}; git ls-tree -r HEAD --name-only | grep -v {}".format(self.path, DIGEST_FILENAME)
-        result = execute_command(cmd1)
+        result, fnames = self.list_git_files()
+        if result["returncode"] != 0:
+            return result
+        return self.gen_files(filename, fnames, self.hash_files(fnames, lfs=self.lfs_pointers), self.content_header())
+
+    def gen_dir(self, filename=DIGEST_FILENAME):
+        if self.lfs_pointers:
+            raise ValueError("lfs pointers require a git work tree, but {} is a plain directory".format(self.path))
+        result, fnames = self.list_dir_files()
+        if result["returncode"] != 0:
+            return result
+        return self.gen_files(filename, fnames, self.hash_files(fnames), self.content_header(ignore=self.ignore))
+
+    def gen_files(self, filename, fnames, hashed, header):
+        if not os.path.isabs(filename):
+            filename = os.path.join(self.path, filename)
+        errors = self.write_manifest(filename, hashed, header=header)
+        return dict(
+            returncode=1 if len(errors) > 0 else 0,
+            stdout="",
+            stderr="".join(["{}\n".format(err) for err in errors]),
+            command="{} {} files with {} {} worker(s) > {}".format(self.hash_engine.algorithm, len(fnames), self.hash_engine.workers, self.hash_engine.pool, filename),
+            cache=self.hash_engine.cache_stats(),
+        )
+
+    # re-hashes only the files changed since the commit recorded in the previous digest file.
+    # the commit is recorded only when the working tree was clean, so the digest file matches that commit exactly.
+    def gen_git_incremental(self, filename=DIGEST_FILENAME):
+        if not os.path.isabs(filename):
+            filename = os.path.join(self.path, filename)
+        head = self.git_objects().info("HEAD")
+        if head is None:
+            return dict(returncode=1, stdout="", stderr="failed to resolve HEAD in {}".format(self.path))
+        head = head[0]
+        with self.metrics.phase(metrics_util.PHASE_LIST):
+            result, dirty = self.git_dirty_files()
         if result["returncode"] != 0:
             return result
-        raw_fname_list = result["stdout"]
-        fname_list = ""
-        for line in raw_fname_list.splitlines():
-            fpath = os.path.join(self.path, line)
-            if os.path.islink(fpath):
+        header = self.content_header() or {manifest.MANIFEST_HEADER_VERSION: manifest.MANIFEST_VERSION, manifest.MANIFEST_HEADER_DIGEST: DIGEST_ALGORITHM_SHA256}
+        if len(dirty) == 0:
+            header[manifest.MANIFEST_HEADER_COMMIT] = head
+
+        base_commit = ""
+        if os.path.exists(filename):
+            previous_header = manifest.read_header(filename)
+            if previous_header.get(manifest.MANIFEST_HEADER_DIGEST) == self.hash_engine.algorithm and previous_header.get(MANIFEST_HEADER_LFS) == header.get(MANIFEST_HEADER_LFS):
+                base_commit = previous_header.get(manifest.MANIFEST_HEADER_COMMIT, "")
+        # e.g. the base commit is no longer reachable after a force-push
+        if base_commit != "" and self.git_objects().info("{}^{{commit}}".format(base_commit)) is None:
+            base_commit = ""
+        if base_commit != "":
+            with self.metrics.phase(metrics_util.PHASE_LIST):
+                result = run_command(["git", "diff", "--raw", "--no-renames", "-z", base_commit, "HEAD"], cwd=self.path, metrics=self.metrics)
+            if result["returncode"] != 0:
+                return result
+
+        if base_commit == "":
+            result, fnames = self.list_files()
+            if result["returncode"] != 0:
+                return result
+            hashed = self.hash_files(fnames, lfs=self.lfs_pointers)
+            self.drop_commit_on_errors(header, hashed)
+            errors = self.write_manifest(filename, hashed, header=header)
+            incremental = dict(base_commit=None, commit=header.get(manifest.MANIFEST_HEADER_COMMIT), hashed=len(fnames), removed=0)
+        else:
+            # --raw -z output is ":<old mode> <new mode> <old oid> <new oid> <status>\0<path>\0" for every path
+            entries = result["stdout"].split("\0")
+            changed = set(dirty)
+            gitlinks = set()
+            for i in range(0, len(entries) - 1, 2):
+                changed.add(entries[i + 1])
+                if entries[i].split(" ")[1] == GIT_MODE_GITLINK:
+                    gitlinks.add(entries[i + 1])
+            # submodules are not listed by a full signing either
+            changed = set([fname for fname in changed if not is_manifest_file(fname) and fname not in gitlinks])
+            previous = manifest.Manifest.load(filename)
+            kept = [(fname, digest.hex(), None) for fname, digest in previous.items() if fname not in changed]
+            rehash = []
+            for fname in sorted(changed):
+                # like in a full signing, only the files of HEAD are signed, and one missing from the working tree
+                # is a hashing error rather than a removal
+                head_object = self.git_objects().info("HEAD:{}".format(fname))
+                if head_object is None or head_object[1] != GIT_OBJECT_TYPE_BLOB or os.path.islink(os.path.join(self.path, fname)):
+                    continue
+                rehash.append(fname)
+            hashed = self.hash_files(rehash, lfs=self.lfs_pointers)
+            rehash = set(rehash)
+            merged = []
+            for fname, old, new in manifest.merge_join(((item[0], item) for item in kept), ((item[0], item) for item in hashed)):
+                merged.append(new if new is not None else old)
+            self.drop_commit_on_errors(header, merged)
+            errors = self.write_manifest(filename, merged, header=header)
+            incremental = dict(base_commit=base_commit, commit=header.get(manifest.MANIFEST_HEADER_COMMIT), hashed=len(rehash), removed=len([fname for fname in changed if fname in previous and fname not in rehash]))
+        return dict(
+            returncode=1 if len(errors) > 0 else 0,
+            stdout="",
+            stderr="".join(["{}\n".format(err) for err in errors]),
+            command="{} {} files > {}".format(self.hash_engine.algorithm, incremental["hashed"], filename),
+            cache=self.hash_engine.cache_stats(),
+            incremental=incremental,
+        )
+
+    # a digest file with errors must not become the base of the next incremental signing
+    def drop_commit_on_errors(self, header, hashed):
+        if any([err is not None for _, _, err in hashed]):
+            header.pop(manifest.MANIFEST_HEADER_COMMIT, None)
+
+    # tracked files whose working tree content may differ from HEAD. the files that git is told not to compare,
+    # with "update-index --assume-unchanged" or "--skip-worktree", are always included, since anyone who can
+    # write to the repository could hide a change that way.
+    def git_dirty_files(self):
+        result = run_command(["git"] + GIT_WORKTREE_CONFIG + ["ls-files", "-v", "-t", "-z"], cwd=self.path, metrics=self.metrics)
+        if result["returncode"] != 0:
+            return result, set()
+        dirty = set()
+        # -v -t -z output is "<tag> <path>\0" for every index entry
+        for entry in result["stdout"].split("\0"):
+            if len(entry) > 2 and (entry[0].islower() or entry[0] == GIT_TAG_SKIP_WORKTREE):
+                dirty.add(entry[2:])
+        result = run_command(["git"] + GIT_WORKTREE_CONFIG + ["status", "--porcelain", "-z", "--untracked-files=no"], cwd=self.path, metrics=self.metrics)
+        if result["returncode"] != 0:
+            return result, set()
+        entries = result["stdout"].split("\0")
+        i = 0
+        while i < len(entries):
+            entry = entries[i]
+            i += 1
+            if len(entry) < 4:
                 continue
-            fname_list = "{}{}\n".format(fname_list, line)
-        tmp_fname_list_file = "/tmp/fname_list.txt"
-        with open(tmp_fname_list_file, "w") as f:
-            f.write(fname_list)
-        cmd2 = "cd {}; cat {} | xargs sha256sum > {}".format(self.path, tmp_fname_list_file, filename)
-        result = execute_command(cmd2)
-        return result
+            dirty.add(entry[3:])
+            # renames and copies are followed by the source path
+            if entry[0] in ["R", "C"] and i < len(entries):
+                dirty.add(entries[i])
+                i += 1
+        result["stdout"] = ""
+        return result, dirty
+
+    # blob ids come straight from the object database; only files that git reports as dirty are re-hashed
+    def git_object_digests(self):
+        with self.metrics.phase(metrics_util.PHASE_LIST):
+            result, hashed = self._git_object_digests()
+        if result["returncode"] == 0:
+            self.metrics.add(metrics_util.COUNTER_FILES_LISTED, len(hashed))
+        return result, hashed
+
+    def _git_object_digests(self):
+        stream = CommandStream(["git", "ls-tree", "-r", "-z", "HEAD"], cwd=self.path, sep=b"\0", metrics=self.metrics)
+        objects = []
+        for entry in stream:
+            if entry == "":
+                continue
+            meta, _, fname = entry.partition("\t")
+            mode, otype, oid = meta.split(" ")
+            if otype != GIT_OBJECT_TYPE_BLOB or mode == GIT_MODE_SYMLINK or is_manifest_file(fname):
+                continue
+            objects.append((fname, oid))
+        if stream.result["returncode"] != 0:
+            return stream.result, []
+
+        result, dirty = self.git_dirty_files()
+        if result["returncode"] != 0:
+            return result, []
+
+        rehash = [fname for fname, _ in objects if fname in dirty and os.path.isfile(os.path.join(self.path, fname))]
+        rehashed = {}
+        if len(rehash) > 0:
+            result = run_command(["git", "hash-object", "--stdin-paths"], cwd=self.path, input="".join(["{}\n".format(fname) for fname in rehash]), metrics=self.metrics)
+            if result["returncode"] != 0:
+                return result, []
+            rehashed = dict(zip(rehash, result["stdout"].splitlines()))
+
+        hashed = []
+        for fname, oid in objects:
+            if fname not in dirty:
+                hashed.append((fname, oid, None))
+            elif fname in rehashed:
+                hashed.append((fname, rehashed[fname], None))
+            else:
+                hashed.append((fname, None, "git hash-object: {}: No such file or directory".format(os.path.join(self.path, fname))))
+        result["stdout"] = ""
+        return result, hashed
+
+    def gen_git_object(self, filename=DIGEST_FILENAME):
+        result, hashed = self.git_object_digests()
+        if result["returncode"] != 0:
+            return result
+        if not os.path.isabs(filename):
+            filename = os.path.join(self.path, filename)
+        header = {manifest.MANIFEST_HEADER_VERSION: manifest.MANIFEST_VERSION, manifest.MANIFEST_HEADER_DIGEST: DIGEST_MODE_GIT_OBJECT}
+        errors = self.write_manifest(filename, hashed, header=header)
+        return dict(
+            returncode=1 if len(errors) > 0 else 0,
+            stdout="",
+            stderr="".join(["{}\n".format(err) for err in errors]),
+            command="git object ids of {} files > {}".format(len(hashed), filename),
+        )
+
+
+def signature_filename(signer_name=""):
+    if not signer_name:
+        return SIGNATURE_FILENAME_GPG
+    return "{}.{}.sig".format(DIGEST_FILENAME, signer_name)
+
+
+# the params of every entry of params["signers"]: the options set in an entry override those of the task.
+# an entry is named after its signature type unless it has a "name", and names must be distinct.
+def signer_params(params):
+    merged = []
+    names = set()
+    for entry in params.get("signers") or []:
+        name = entry.get("name") or entry.get("signature_type") or params.get("signature_type") or SIGNATURE_TYPE_GPG
+        if not SIGNER_NAME_PATTERN.match(name):
+            raise ValueError("a signer name may only contain letters, digits, \"_\", \".\" and \"-\": {}".format(name))
+        if name in names:
+            raise ValueError("signers need distinct names; set \"name\" for each signer of the same type: {}".format(name))
+        names.add(name)
+        entry_params = dict(params)
+        entry_params.update((k, v) for k, v in entry.items() if v is not None and k != "name")
+        entry_params["signers"] = None
+        entry_params["signer_name"] = name
+        merged.append(entry_params)
+    return merged
+
+
+def is_manifest_name(name):
+    return name == merkle.MERKLE_FILENAME or MANIFEST_NAME_PATTERN.match(name) is not None
+
+
+# the digest file, its signatures and the merkle tree file at the root are not part of the signed content;
+# files of the same name in subdirectories are
+def is_manifest_file(fname):
+    return "/" not in fname and is_manifest_name(fname)
+
+
+def normalize_path(path):
+    path = os.path.normpath(path).strip("/")
+    if path == ".":
+        return ""
+    return path
+
+
+def is_under(fname, prefixes):
+    for prefix in prefixes:
+        if prefix == "" or fname == prefix or fname.startswith(prefix + "/"):
+            return True
+    return False
+
 
 def result_object_to_dict(obj):
     if not isinstance(obj, subprocess.CompletedProcess):
@@ -131,29 +1135,122 @@ def result_object_to_dict(obj):
         stderr=obj.stderr,
     )
 
-def execute_command(cmd="", env_params=None, timeout=None):
+def execute_command(cmd="", env_params=None, timeout=None, input=None):
     env = None
     if env_params is not None:
         env = os.environ.copy()
         env.update(env_params)
     result = subprocess.run(
-            cmd, shell=True, env=env, timeout=timeout,
+            cmd, shell=True, env=env, timeout=timeout, input=input,
             stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
     result = result_object_to_dict(result)
     result["command"] = cmd
     return result
 
 
-def get_cosign_path():
-    cmd1 = "command -v cosign"
-    result = execute_command(cmd1)
-    if result["returncode"] == 0:
-        return "cosign"
+def command_env(env_params):
+    if env_params is None:
+        return None
+    env = os.environ.copy()
+    env.update(env_params)
+    return env
 
-    if os.path.exists(TMP_COSIGN_PATH):
-        return TMP_COSIGN_PATH
 
-    os_name = platform.system().lower()
+# runs an argv list without a shell. the result has the same keys as execute_command()
+def run_command(argv, cwd=None, env_params=None, timeout=None, input=None, metrics=None):
+    if metrics is not None:
+        metrics.add(metrics_util.COUNTER_SUBPROCESSES)
+    try:
+        result = subprocess.run(
+                argv, cwd=cwd, env=command_env(env_params), timeout=timeout, input=input,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, errors="surrogateescape")
+    except OSError as e:
+        # same exit status as a shell that cannot run the command
+        return dict(returncode=127, stdout="", stderr="{}: {}\n".format(argv[0], e.strerror), command=shlex.join(argv))
+    result = result_object_to_dict(result)
+    result["command"] = shlex.join(argv)
+    return result
+
+
+# runs an argv list and yields its stdout split by `sep` while the command is running,
+# instead of buffering the whole output. `result` is set once the output is consumed.
+class CommandStream:
+    def __init__(self, argv, cwd=None, env_params=None, sep=b"\n", metrics=None):
+        self.argv = argv
+        self.cwd = cwd
+        self.env_params = env_params
+        self.sep = sep
+        self.metrics = metrics
+        self.result = None
+
+    def __iter__(self):
+        if self.metrics is not None:
+            self.metrics.add(metrics_util.COUNTER_SUBPROCESSES)
+        with tempfile.TemporaryFile() as stderr:
+            proc = subprocess.Popen(self.argv, cwd=self.cwd, env=command_env(self.env_params), stdout=subprocess.PIPE, stderr=stderr)
+            try:
+                rest = b""
+                while True:
+                    chunk = proc.stdout.read1(HASH_READ_SIZE)
+                    if not chunk:
+                        break
+                    records = (rest + chunk).split(self.sep)
+                    rest = records.pop()
+                    for record in records:
+                        yield record.decode("utf-8", "surrogateescape")
+                if rest:
+                    yield rest.decode("utf-8", "surrogateescape")
+            finally:
+                proc.stdout.close()
+                returncode = proc.wait()
+            stderr.seek(0)
+            self.result = dict(
+                returncode=returncode,
+                stdout="",
+                stderr=stderr.read().decode("utf-8", "replace"),
+                command=shlex.join(self.argv),
+            )
+
+
+# a long-lived "git cat-file --batch-check" process answering many object lookups for one repository
+class GitObjectReader:
+    def __init__(self, path, metrics=None):
+        self.path = path
+        self.metrics = metrics
+        self.proc = None
+
+    def _start(self):
+        if self.metrics is not None:
+            self.metrics.add(metrics_util.COUNTER_SUBPROCESSES)
+        self.proc = subprocess.Popen(
+            ["git", "cat-file", "--batch-check"], cwd=self.path,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    # returns (oid, type, size) or None if the object does not exist
+    def info(self, rev):
+        if self.proc is None:
+            self._start()
+        self.proc.stdin.write("{}\n".format(rev).encode("utf-8", "surrogateescape"))
+        self.proc.stdin.flush()
+        line = self.proc.stdout.readline().decode("utf-8", "surrogateescape").rstrip("\n")
+        items = line.split(" ")
+        if len(items) != 3 or items[1] == "missing":
+            return None
+        return items[0], items[1], int(items[2])
+
+    def close(self):
+        if self.proc is not None:
+            self.proc.stdin.close()
+            self.proc.stdout.close()
+            self.proc.wait()
+            self.proc = None
+
+
+_cosign_resolutions = {}
+_cosign_lock = threading.Lock()
+
+
+def get_cosign_arch():
     machine = platform.uname().machine
     arch = "unknown"
     if machine == "x86_64":
@@ -166,12 +1263,128 @@ def get_cosign_path():
         arch = "s390x"
     else:
         arch = machine
+    return arch
+
+
+def _cosign_bundle_binary(bundle_dir):
+    os_name = platform.system().lower()
+    for name in ["cosign-{}-{}".format(os_name, get_cosign_arch()), "cosign"]:
+        candidate = os.path.join(bundle_dir, name)
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def _read_cosign_record(record_file):
+    try:
+        with open(record_file, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_cosign_record(record_file, record):
+    try:
+        cache_dir = os.path.dirname(record_file)
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        tmp_fd, tmp_file = tempfile.mkstemp(dir=cache_dir, prefix=".{}.".format(COSIGN_RECORD_FILENAME))
+        with os.fdopen(tmp_fd, "w") as f:
+            json.dump(record, f)
+        os.replace(tmp_file, record_file)
+    except OSError:
+        pass
+
 
-    cmd2 = "curl -sL -o {} https://github.com/sigstore/cosign/releases/download/v1.4.1/cosign-{}-{} && chmod +x {}".format(TMP_COSIGN_PATH, os_name, arch, TMP_COSIGN_PATH)
-    result = execute_command(cmd2)
-    if result["returncode"] == 0:
-        cmd3 = "{} initialize".format(TMP_COSIGN_PATH)
-        execute_command(cmd3)
-        return TMP_COSIGN_PATH
+# returns the cosign binary as a dict with its path, sha256, version and where it was found.
+# the result is memoized per process and persisted in the cache dir, keyed by the binary's stat,
+# so the binary is hashed and `cosign version` is run only once per installed binary.
+def _inspect_cosign(path, source, cache_dir=""):
+    st = os.stat(path)
+    stat_key = [st.st_size, st.st_mtime_ns, st.st_ino]
+    cache_dir = cache_dir or default_cache_dir()
+    if cache_dir.startswith("~/"):
+        cache_dir = os.path.expanduser(cache_dir)
+    record_file = os.path.join(cache_dir, COSIGN_RECORD_FILENAME)
+    records = _read_cosign_record(record_file)
+    record = records.get(path)
+    if record is None or record.get("stat") != stat_key:
+        version = ""
+        result = run_command([path, "version"])
+        for line in "{}\n{}".format(result["stdout"], result["stderr"]).splitlines():
+            if line.startswith("GitVersion:"):
+                version = line.split(":", 1)[1].strip()
+        record = dict(stat=stat_key, sha256=sha256_file(path), version=version)
+        records[path] = record
+        _write_cosign_record(record_file, records)
+    return dict(path=path, sha256=record["sha256"], version=record["version"], source=source)
+
+
+def resolve_cosign(cosign_path="", cosign_sha256="", allow_download=True, cache_dir="", workspace=None):
+    key = (cosign_path, cosign_sha256.lower(), allow_download, cache_dir)
+    start = time.monotonic()
+    with _cosign_lock:
+        resolved = _cosign_resolutions.get(key)
+        if resolved is None:
+            resolved = _resolve_cosign(cosign_path, cosign_sha256.lower(), allow_download, cache_dir, workspace)
+            _cosign_resolutions[key] = resolved
+    resolved = dict(resolved)
+    resolved["resolution_time"] = round(time.monotonic() - start, 6)
+    return resolved
+
+
+def _resolve_cosign(cosign_path, cosign_sha256, allow_download, cache_dir, workspace):
+    candidates = []
+    if cosign_path != "":
+        if cosign_path.startswith("~/"):
+            cosign_path = os.path.expanduser(cosign_path)
+        binary = _cosign_bundle_binary(cosign_path) if os.path.isdir(cosign_path) else cosign_path
+        if binary is None or not os.path.isfile(binary):
+            raise ValueError("cosign binary is not found at \"{}\"".format(cosign_path))
+        candidates.append((binary, "cosign_path"))
     else:
-        raise ValueError("failed to install cosign command; {}".format(result["stderr"]))
+        in_path = shutil.which("cosign")
+        if in_path is not None:
+            candidates.append((os.path.realpath(in_path), "PATH"))
+        if os.path.exists(TMP_COSIGN_PATH):
+            candidates.append((TMP_COSIGN_PATH, "downloaded"))
+
+    for binary, source in candidates:
+        resolved = _inspect_cosign(binary, source, cache_dir=cache_dir)
+        if cosign_sha256 != "" and resolved["sha256"] != cosign_sha256:
+            if source == "cosign_path":
+                raise ValueError("sha256 of cosign binary \"{}\" does not match the pinned digest; expected {}, got {}".format(binary, cosign_sha256, resolved["sha256"]))
+            continue
+        return resolved
+
+    if not allow_download:
+        raise ValueError("cosign command is not found and downloading is disabled; install cosign or set cosign_path to a pre-staged binary or offline bundle")
+
+    os_name = platform.system().lower()
+    arch = get_cosign_arch()
+    owned_workspace = workspace is None
+    if owned_workspace:
+        workspace = Workspace()
+    try:
+        tmp_download = workspace.path("cosign")
+        url = "https://github.com/sigstore/cosign/releases/download/{}/cosign-{}-{}".format(COSIGN_VERSION, os_name, arch)
+        result = run_command(["curl", "-sfL", "-o", tmp_download, url])
+        if result["returncode"] != 0:
+            raise ValueError("failed to install cosign command; {}".format(result["stderr"]))
+        if cosign_sha256 != "" and sha256_file(tmp_download) != cosign_sha256:
+            raise ValueError("sha256 of the downloaded cosign binary does not match the pinned digest {}".format(cosign_sha256))
+        # install with a rename in the destination directory, since the workspace may be on another filesystem
+        tmp_fd, tmp_install = tempfile.mkstemp(dir=os.path.dirname(TMP_COSIGN_PATH), prefix=".cosign.")
+        os.close(tmp_fd)
+        shutil.copyfile(tmp_download, tmp_install)
+        os.chmod(tmp_install, 0o755)
+        os.replace(tmp_install, TMP_COSIGN_PATH)
+        os.remove(tmp_download)
+    finally:
+        if owned_workspace:
+            workspace.cleanup()
+    run_command([TMP_COSIGN_PATH, "initialize"])
+    return _inspect_cosign(TMP_COSIGN_PATH, "downloaded", cache_dir=cache_dir)
+
+
+def get_cosign_path(cosign_path="", cosign_sha256="", allow_download=True):
+    return resolve_cosign(cosign_path=cosign_path, cosign_sha256=cosign_sha256, allow_download=allow_download)["path"]
@@ -0,0 +1,75 @@
+import concurrent.futures
+import fnmatch
+import os
+
+
+# glob patterns as in .gitignore, without negation: a pattern containing "/" matches the path relative to
+# the root (a leading "/" is dropped), otherwise it matches the name at any depth. a trailing "/" only
+# matches directories, and files under an ignored directory are ignored too.
+def is_ignored(rel_path, name, is_dir, patterns):
+    for pattern in patterns:
+        dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        if dir_only and not is_dir:
+            continue
+        if "/" in pattern:
+            if fnmatch.fnmatchcase(rel_path, pattern.lstrip("/")):
+                return True
+        elif fnmatch.fnmatchcase(name, pattern):
+            return True
+    return False
+
+
+# whether a file at `rel_path` is ignored, either itself or through one of its parent directories
+def is_ignored_path(rel_path, patterns):
+    parts = rel_path.split("/")
+    for i in range(len(parts)):
+        if is_ignored("/".join(parts[:i + 1]), parts[i], i < len(parts) - 1, patterns):
+            return True
+    return False
+
+
+def _scan_dir(root, rel_dir, ignore, skip):
+    files = []
+    dirs = []
+    with os.scandir(os.path.join(root, rel_dir) if rel_dir else root) as it:
+        for entry in it:
+            rel_path = "{}/{}".format(rel_dir, entry.name) if rel_dir else entry.name
+            # the file type comes from the directory entry, so nothing is stat'ed on most filesystems
+            if entry.is_symlink():
+                continue
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if len(ignore) > 0 and is_ignored(rel_path, entry.name, is_dir, ignore):
+                continue
+            if is_dir:
+                dirs.append(rel_path)
+            elif entry.is_file(follow_symlinks=False) and not (skip is not None and skip(rel_path)):
+                files.append(rel_path)
+    return files, dirs
+
+
+# lists the regular files under `root` as sorted "/"-separated relative paths, scanning directories
+# in parallel. symlinks are skipped like in git listings, and files for which `skip(rel_path)` is true are left out.
+# returns (fnames, errors) where errors are the directories that could not be read.
+def walk_dir_files(root, ignore=None, skip=None, workers=0):
+    ignore = list(ignore or [])
+    if not workers or workers < 0:
+        workers = os.cpu_count() or 1
+    fnames = []
+    errors = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(_scan_dir, root, "", ignore, skip): ""}
+        while len(pending) > 0:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                rel_dir = pending.pop(future)
+                try:
+                    files, dirs = future.result()
+                except OSError as e:
+                    errors.append("{}: {}".format(os.path.join(root, rel_dir), e.strerror))
+                    continue
+                fnames += files
+                for d in dirs:
+                    pending[executor.submit(_scan_dir, root, d, ignore, skip)] = d
+    fnames.sort()
+    return fnames, errors
@@ -0,0 +1,168 @@
+import bisect
+
+
+# versioned digest files start with "#key: value" header lines; plain sha256sum output has no header
+MANIFEST_VERSION = "2"
+MANIFEST_HEADER_PREFIX = "#"
+MANIFEST_HEADER_VERSION = "manifest-version"
+MANIFEST_HEADER_DIGEST = "digest"
+MANIFEST_HEADER_COMMIT = "commit"
+
+DIFF_ADDED = "added"
+DIFF_REMOVED = "removed"
+DIFF_MODIFIED = "modified"
+
+
+# same escaping rule as coreutils sha256sum for names containing "\\" or a newline
+def format_digest_line(hexdigest, fname):
+    if "\\" in fname or "\n" in fname:
+        fname = fname.replace("\\", "\\\\").replace("\n", "\\n")
+        return "\\{}  {}\n".format(hexdigest, fname)
+    return "{}  {}\n".format(hexdigest, fname)
+
+
+def parse_digest_line(line):
+    escaped = line.startswith("\\")
+    if escaped:
+        line = line[1:]
+    hexdigest, sep, fname = line.partition(" ")
+    if sep == "" or len(fname) == 0 or fname[0] not in [" ", "*"]:
+        raise ValueError("invalid digest line: {}".format(line))
+    fname = fname[1:]
+    if escaped:
+        fname = fname.replace("\\\\", "\0").replace("\\n", "\n").replace("\0", "\\")
+    return hexdigest.lower(), fname
+
+
+def read_header(filename):
+    header = {}
+    with open(filename, "r", newline="\n") as f:
+        for line in f:
+            if not line.startswith(MANIFEST_HEADER_PREFIX):
+                break
+            key, _, value = line[len(MANIFEST_HEADER_PREFIX):].rstrip("\n").partition(":")
+            header[key.strip()] = value.strip()
+    return header
+
+
+# yields (digest, fname) lazily, with the digest as raw bytes
+def iter_records(filename):
+    with open(filename, "r", newline="\n") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line == "" or line.startswith(MANIFEST_HEADER_PREFIX):
+                continue
+            hexdigest, fname = parse_digest_line(line)
+            yield bytes.fromhex(hexdigest), fname
+
+
+# writes (fname, hexdigest, error) entries and returns the errors; entries with an error are left out
+def write_manifest(filename, hashed, header=None):
+    errors = []
+    with open(filename, "w") as f:
+        if header:
+            for key, value in header.items():
+                f.write("{}{}: {}\n".format(MANIFEST_HEADER_PREFIX, key, value))
+        for fname, hexdigest, err in hashed:
+            if err is not None:
+                errors.append(err)
+                continue
+            f.write(format_digest_line(hexdigest, fname))
+    return errors
+
+
+# a manifest held as a sorted list of names plus one contiguous bytearray of fixed-size binary digests
+class Manifest:
+    def __init__(self, header=None):
+        self.header = header or {}
+        self.fnames = []
+        self.digests = bytearray()
+        self.digest_size = 0
+
+    @classmethod
+    def load(cls, filename):
+        m = cls(header=read_header(filename))
+        in_order = True
+        for digest, fname in iter_records(filename):
+            if m.digest_size == 0:
+                m.digest_size = len(digest)
+            elif len(digest) != m.digest_size:
+                raise ValueError("digest length of \"{}\" differs from the other entries in {}".format(fname, filename))
+            if in_order and len(m.fnames) > 0 and fname <= m.fnames[-1]:
+                in_order = False
+            m.fnames.append(fname)
+            m.digests += digest
+        if not in_order:
+            m._sort()
+        return m
+
+    def _sort(self):
+        size = self.digest_size
+        order = sorted(range(len(self.fnames)), key=self.fnames.__getitem__)
+        digests = bytearray()
+        fnames = []
+        for i in order:
+            # keep the last entry for duplicated names, like a dict would
+            if len(fnames) > 0 and fnames[-1] == self.fnames[i]:
+                digests[-size:] = self.digests[i * size:(i + 1) * size]
+                continue
+            fnames.append(self.fnames[i])
+            digests += self.digests[i * size:(i + 1) * size]
+        self.fnames = fnames
+        self.digests = digests
+
+    def __len__(self):
+        return len(self.fnames)
+
+    def __contains__(self, fname):
+        return self._index(fname) is not None
+
+    def _index(self, fname):
+        i = bisect.bisect_left(self.fnames, fname)
+        if i < len(self.fnames) and self.fnames[i] == fname:
+            return i
+        return None
+
+    def get(self, fname, default=None):
+        i = self._index(fname)
+        if i is None:
+            return default
+        return bytes(self.digests[i * self.digest_size:(i + 1) * self.digest_size])
+
+    # yields (fname, digest) sorted by name
+    def items(self):
+        size = self.digest_size
+        view = memoryview(self.digests)
+        for i, fname in enumerate(self.fnames):
+            yield fname, bytes(view[i * size:(i + 1) * size])
+
+
+# merge-join of two (fname, digest) streams sorted by name.
+# yields (fname, left_digest, right_digest) for every name, with None on the side where it is missing.
+def merge_join(left, right):
+    left = iter(left)
+    right = iter(right)
+    lnext = next(left, None)
+    rnext = next(right, None)
+    while lnext is not None or rnext is not None:
+        if rnext is None or (lnext is not None and lnext[0] < rnext[0]):
+            yield lnext[0], lnext[1], None
+            lnext = next(left, None)
+        elif lnext is None or rnext[0] < lnext[0]:
+            yield rnext[0], None, rnext[1]
+            rnext = next(right, None)
+        else:
+            yield lnext[0], lnext[1], rnext[1]
+            lnext = next(left, None)
+            rnext = next(right, None)
+
+
+# yields (DIFF_ADDED / DIFF_REMOVED / DIFF_MODIFIED, fname) for a signed and a current sorted stream
+def diff(signed, current):
+    for fname, signed_digest, current_digest in merge_join(signed, current):
+        if signed_digest is None:
+            yield DIFF_ADDED, fname
+        elif current_digest is None:
+            yield DIFF_REMOVED, fname
+        elif signed_digest != current_digest:
+            yield DIFF_MODIFIED, fname
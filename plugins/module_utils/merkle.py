@@ -0,0 +1,128 @@
+import collections
+import hashlib
+import ansible_collections.playbook.integrity.plugins.module_utils.manifest as manifest
+
+
+MERKLE_FILENAME = "sha256tree.txt"
+MANIFEST_HEADER_MERKLE_ROOT = "merkle-root"
+
+# directories are written with a trailing "/", and the root directory as "./"
+DIR_SUFFIX = "/"
+ROOT_NAME = "./"
+
+NODE_TYPE_FILE = "f"
+NODE_TYPE_DIR = "d"
+
+
+def parent_dir(path):
+    return path.rpartition("/")[0]
+
+
+def node_name(path):
+    return path.rpartition("/")[2]
+
+
+def dir_entry_name(dirpath):
+    if dirpath == "":
+        return ROOT_NAME
+    return dirpath + DIR_SUFFIX
+
+
+# a directory's digest is the sha256 over its direct children sorted by name.
+# `children` is a list of (name, node type, hexdigest).
+def node_digest(children):
+    h = hashlib.sha256()
+    for name, node_type, hexdigest in sorted(children):
+        h.update("{}\0{}\0{}\0".format(node_type, hexdigest, name).encode("utf-8", "surrogateescape"))
+    return h.hexdigest()
+
+
+def _children_index(file_digests, dirs=None):
+    children = collections.defaultdict(list)
+    known_dirs = set([""])
+    for fname, hexdigest in file_digests:
+        children[parent_dir(fname)].append((node_name(fname), NODE_TYPE_FILE, hexdigest))
+        d = parent_dir(fname)
+        while d not in known_dirs:
+            known_dirs.add(d)
+            d = parent_dir(d)
+    if dirs is not None:
+        known_dirs.update(dirs)
+    return children, known_dirs
+
+
+# returns {dirpath: hexdigest} for every directory, with "" as the root
+def build_dir_digests(file_digests):
+    children, known_dirs = _children_index(file_digests)
+    dir_digests = {}
+    # deepest directories first, so every child digest exists before its parent is computed
+    for d in sorted(known_dirs, key=lambda d: d.count("/") + (d != ""), reverse=True):
+        dir_digests[d] = node_digest(children[d])
+        if d != "":
+            children[parent_dir(d)].append((node_name(d), NODE_TYPE_DIR, dir_digests[d]))
+    return dir_digests
+
+
+def write_tree(filename, hashed, dir_digests, header=None):
+    entries = [(fname, hexdigest, None) for fname, hexdigest, err in hashed if err is None]
+    entries += [(dir_entry_name(d), hexdigest, None) for d, hexdigest in dir_digests.items()]
+    entries.sort()
+    return manifest.write_manifest(filename, entries, header=header)
+
+
+class MerkleTree:
+    def __init__(self, files, dirs):
+        self.files = files
+        self.dirs = dirs
+        self.children, _ = _children_index(files.items())
+        for d in dirs:
+            if d != "":
+                self.children[parent_dir(d)].append((node_name(d), NODE_TYPE_DIR, None))
+
+    @classmethod
+    def load(cls, filename):
+        files = {}
+        dirs = {}
+        for digest, fname in manifest.iter_records(filename):
+            if fname == ROOT_NAME:
+                dirs[""] = digest.hex()
+            elif fname.endswith(DIR_SUFFIX):
+                dirs[fname[:-len(DIR_SUFFIX)]] = digest.hex()
+            else:
+                files[fname] = digest.hex()
+        return cls(files, dirs)
+
+    # signed file digests under `path`, which is either a file or a directory
+    def files_under(self, path):
+        if path in self.files:
+            return {path: self.files[path]}
+        prefix = "" if path == "" else path + "/"
+        return dict((fname, hexdigest) for fname, hexdigest in self.files.items() if fname.startswith(prefix))
+
+    # recomputes the root from the tree entries under `path` plus the sibling digests of every
+    # ancestor, so that a match with the signed root authenticates the entries under `path`.
+    def root_from(self, path):
+        if path in self.files:
+            digest = self.files[path]
+            node_type = NODE_TYPE_FILE
+        else:
+            if path not in self.dirs:
+                raise ValueError("\"{}\" is not found in the merkle tree".format(path))
+            digest = build_dir_digests(
+                [(fname[len(path) + 1:] if path != "" else fname, hexdigest) for fname, hexdigest in self.files_under(path).items()]
+            )[""]
+            node_type = NODE_TYPE_DIR
+        while path != "":
+            name = node_name(path)
+            parent = parent_dir(path)
+            siblings = []
+            for child_name, child_type, child_digest in self.children[parent]:
+                if child_name == name and child_type == node_type:
+                    continue
+                if child_type == NODE_TYPE_DIR:
+                    child_digest = self.dirs[parent + "/" + child_name if parent != "" else child_name]
+                siblings.append((child_name, child_type, child_digest))
+            digest = node_digest(siblings + [(name, node_type, digest)])
+            node_type = NODE_TYPE_DIR
+            path = parent
+        return digest
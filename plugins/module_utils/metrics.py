@@ -0,0 +1,166 @@
+import contextlib
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+
+PHASE_LIST = "list"
+PHASE_HASH = "hash"
+PHASE_COMPARE = "compare"
+PHASE_WRITE = "write"
+PHASE_SIGN = "sign"
+PHASE_VERIFY = "verify"
+PHASE_COSIGN = "cosign"
+
+COUNTER_FILES_LISTED = "files_listed"
+COUNTER_FILES_HASHED = "files_hashed"
+COUNTER_FILES_CACHED = "files_cached"
+COUNTER_BYTES_HASHED = "bytes_hashed"
+COUNTER_SUBPROCESSES = "subprocesses"
+
+METRICS_FORMAT_PROMETHEUS = "prometheus"
+METRICS_FORMAT_OPENMETRICS = "openmetrics"
+METRIC_NAME_PREFIX = "playbook_integrity_"
+
+
+def _children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+def _peak_rss_bytes(who):
+    maxrss = resource.getrusage(who).ru_maxrss
+    if sys.platform == "darwin":
+        return maxrss
+    return maxrss * 1024
+
+
+# per-phase wall / cpu time and counters of one sign or verify run.
+# cpu is the cpu time of this process (all threads), and children_cpu that of the finished subprocesses.
+# phases may nest (e.g. "cosign" within "sign") or overlap when the verification stages run concurrently,
+# so the phase times do not add up to the total.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.counters = {}
+        self.started = time.perf_counter()
+        self.cpu_started = time.process_time()
+        self.children_cpu_started = _children_cpu()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        children_cpu = _children_cpu()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            children_cpu = _children_cpu() - children_cpu
+            with self.lock:
+                phase = self.phases.setdefault(name, dict(wall=0.0, cpu=0.0, children_cpu=0.0, count=0))
+                phase["wall"] += wall
+                phase["cpu"] += cpu
+                phase["children_cpu"] += children_cpu
+                phase["count"] += 1
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def as_dict(self):
+        with self.lock:
+            phases = dict((name, dict((k, round(v, 6)) for k, v in phase.items())) for name, phase in self.phases.items())
+            counters = dict(self.counters)
+        for name in [COUNTER_FILES_LISTED, COUNTER_FILES_HASHED, COUNTER_FILES_CACHED, COUNTER_BYTES_HASHED, COUNTER_SUBPROCESSES]:
+            counters.setdefault(name, 0)
+        return dict(
+            wall=round(time.perf_counter() - self.started, 6),
+            cpu=round(time.process_time() - self.cpu_started, 6),
+            children_cpu=round(_children_cpu() - self.children_cpu_started, 6),
+            peak_rss_bytes=_peak_rss_bytes(resource.RUSAGE_SELF),
+            children_peak_rss_bytes=_peak_rss_bytes(resource.RUSAGE_CHILDREN),
+            phases=phases,
+            counters=counters,
+        )
+
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_sample(name, labels, value):
+    label_str = ",".join(["{}=\"{}\"".format(k, _escape_label_value(v)) for k, v in labels.items()])
+    return "{}{}{{{}}} {}\n".format(METRIC_NAME_PREFIX, name, label_str, value)
+
+
+# formats (labels, metrics dict) pairs as gauges in the Prometheus text format, or in OpenMetrics
+def format_metrics(samples, metrics_format=METRICS_FORMAT_PROMETHEUS):
+    if metrics_format not in [METRICS_FORMAT_PROMETHEUS, METRICS_FORMAT_OPENMETRICS]:
+        raise ValueError("this metrics format is not supported: {}".format(metrics_format))
+    families = {}
+
+    def add(name, help_text, labels, value):
+        families.setdefault(name, (help_text, []))[1].append(_format_sample(name, labels, value))
+
+    for labels, m in samples:
+        if "failed" in m:
+            add("failed", "1 if the run failed, otherwise 0.", labels, m["failed"])
+        add("wall_seconds", "Wall time of the run.", labels, m["wall"])
+        add("cpu_seconds", "CPU time of the run.", labels, m["cpu"])
+        add("children_cpu_seconds", "CPU time of the subprocesses of the run.", labels, m["children_cpu"])
+        add("peak_rss_bytes", "Peak resident set size of the process.", labels, m["peak_rss_bytes"])
+        add("children_peak_rss_bytes", "Peak resident set size of the largest subprocess.", labels, m["children_peak_rss_bytes"])
+        for phase_name, phase in sorted(m["phases"].items()):
+            phase_labels = dict(labels, phase=phase_name)
+            add("phase_wall_seconds", "Wall time spent in a phase.", phase_labels, phase["wall"])
+            add("phase_cpu_seconds", "CPU time spent in a phase.", phase_labels, phase["cpu"])
+            add("phase_children_cpu_seconds", "CPU time of the subprocesses finished in a phase.", phase_labels, phase["children_cpu"])
+        for counter_name, value in sorted(m["counters"].items()):
+            add(counter_name, "Number of {} in the run.".format(counter_name.replace("_", " ")), labels, value)
+
+    lines = []
+    for name, (help_text, family_samples) in families.items():
+        lines.append("# HELP {}{} {}\n".format(METRIC_NAME_PREFIX, name, help_text))
+        lines.append("# TYPE {}{} gauge\n".format(METRIC_NAME_PREFIX, name))
+        lines += family_samples
+    if metrics_format == METRICS_FORMAT_OPENMETRICS:
+        lines.append("# EOF\n")
+    return "".join(lines)
+
+
+# written atomically, so that e.g. the node_exporter textfile collector never reads a partial file
+def write_metrics_file(filename, samples, metrics_format=METRICS_FORMAT_PROMETHEUS):
+    text = format_metrics(samples, metrics_format=metrics_format)
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=".{}.".format(os.path.basename(filename)))
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, filename)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+# (labels, metrics) pairs of a sign / verify module result, for a single target or "targets"
+def result_samples(module_name, params, detail):
+    results = detail.get("results", [detail])
+    samples = []
+    for result in results:
+        if "metrics" not in result:
+            continue
+        labels = dict(
+            module=module_name,
+            target=result.get("target", params.get("target") or ""),
+            signature_type=params.get("signature_type", ""),
+        )
+        samples.append((labels, dict(result["metrics"], failed=int(bool(result.get("failed", False))))))
+    return samples
@@ -0,0 +1,117 @@
+import asyncio
+import shlex
+import ansible_collections.playbook.integrity.plugins.module_utils.common as common
+import ansible_collections.playbook.integrity.plugins.module_utils.metrics as metrics_util
+
+
+STAGE_DIGEST = "digest_result"
+STAGE_SIGNATURE = "verify_result"
+
+
+async def run_command_async(argv, cwd=None, env_params=None, metrics=None):
+    if metrics is not None:
+        metrics.add(metrics_util.COUNTER_SUBPROCESSES)
+    proc = await asyncio.create_subprocess_exec(
+        *argv, cwd=cwd, env=common.command_env(env_params),
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    try:
+        stdout, stderr = await proc.communicate()
+    except asyncio.CancelledError:
+        proc.kill()
+        await proc.wait()
+        raise
+    return dict(
+        returncode=proc.returncode,
+        stdout=stdout.decode("utf-8", "replace"),
+        stderr=stderr.decode("utf-8", "replace"),
+        command=shlex.join(argv),
+    )
+
+
+async def _signature_stage(command, finish, metrics):
+    with metrics.phase(metrics_util.PHASE_VERIFY):
+        try:
+            result = await run_command_async(metrics=metrics, **command)
+        except OSError as e:
+            result = dict(returncode=127, stdout="", stderr="{}: {}\n".format(command["argv"][0], e.strerror), command=shlex.join(command["argv"]))
+    return finish(result)
+
+
+# the signature check only reads the digest file and its signature, so it runs while the working tree is hashed.
+# whichever stage fails first cancels the other one.
+async def _run_verification(digester, command, finish, paths=None):
+    loop = asyncio.get_running_loop()
+    stages = {
+        asyncio.ensure_future(loop.run_in_executor(None, lambda: digester.check(paths=paths))): STAGE_DIGEST,
+        asyncio.ensure_future(_signature_stage(command, finish, digester.metrics)): STAGE_SIGNATURE,
+    }
+    result = {"failed": False}
+    pending = set(stages.keys())
+    while len(pending) > 0:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            result[stages[task]] = task.result()
+            if result[stages[task]]["returncode"] != 0:
+                result["failed"] = True
+        if result["failed"] and len(pending) > 0:
+            for task in pending:
+                if stages[task] == STAGE_DIGEST:
+                    digester.cancel()
+                task.cancel()
+                result[stages[task]] = dict(returncode=1, stdout="", stderr="cancelled because the other verification stage failed", cancelled=True)
+            break
+    return result
+
+
+def run_verification(digester, command, finish, paths=None):
+    return asyncio.run(_run_verification(digester, command, finish, paths=paths))
+
+
+
+# checks the signatures of several signers while the working tree is hashed, and stops as soon as `required`
+# of them have passed or so many have failed that `required` can no longer be reached; the checks still
+# running then are cancelled. `checks` is a list of (name, command, finish) and `failed` holds the results
+# of the signers that could not be checked at all. `digester` is None when the digests have been checked already.
+async def _run_policy_verification(digester, checks, required, metrics, paths=None, failed=None):
+    loop = asyncio.get_running_loop()
+    stages = {}
+    for name, command, finish in checks:
+        stages[asyncio.ensure_future(_signature_stage(command, finish, metrics))] = name
+    if digester is not None:
+        stages[asyncio.ensure_future(loop.run_in_executor(None, lambda: digester.check(paths=paths)))] = STAGE_DIGEST
+    signatures = dict(failed or {})
+    total = len(checks) + len(signatures)
+    result = {"failed": False}
+    pending = set(stages.keys())
+    while len(pending) > 0:
+        passed = len([r for r in signatures.values() if r["returncode"] == 0])
+        failed_count = len([r for r in signatures.values() if r["returncode"] != 0 and not r.get("cancelled", False)])
+        if result.get(STAGE_DIGEST, {}).get("returncode", 0) != 0 or failed_count > total - required:
+            break
+        if passed >= required:
+            # the policy is satisfied; the other signatures need no checking, but the digests still do
+            for task in [task for task in pending if stages[task] != STAGE_DIGEST]:
+                task.cancel()
+                pending.discard(task)
+                signatures[stages[task]] = dict(returncode=1, stdout="", stderr="not checked because the signature policy was already satisfied", cancelled=True)
+            if len(pending) == 0:
+                break
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if stages[task] == STAGE_DIGEST:
+                result[STAGE_DIGEST] = task.result()
+            else:
+                signatures[stages[task]] = task.result()
+    for task in pending:
+        if stages[task] == STAGE_DIGEST:
+            digester.cancel()
+            result[STAGE_DIGEST] = dict(returncode=1, stdout="", stderr="cancelled because the signature policy failed", cancelled=True)
+        else:
+            signatures[stages[task]] = dict(returncode=1, stdout="", stderr="cancelled because the verification already failed", cancelled=True)
+        task.cancel()
+    result["signatures"] = signatures
+    return result
+
+
+def run_policy_verification(digester, checks, required, metrics, paths=None, failed=None):
+    return asyncio.run(_run_policy_verification(digester, checks, required, metrics, paths=paths, failed=failed))
@@ -1,61 +1,128 @@
 
+import concurrent.futures
 import os
 import ansible_collections.playbook.integrity.plugins.module_utils.common as common
+import ansible_collections.playbook.integrity.plugins.module_utils.metrics as metrics_util
+import ansible_collections.playbook.integrity.plugins.module_utils.sigstore as sigstore
 
 
 class Signer:
     def __init__(self, params):
+        self.params = params
         self.type = params.get("type", "")
         self.target = params.get("target", "")
         if self.target.startswith("~/"):
             self.target = os.path.expanduser(self.target)
         self.signature_type = params.get("signature_type", "gpg")
         self.private_key = params.get("private_key", "")
+        if self.private_key.startswith("~/"):
+            self.private_key = os.path.expanduser(self.private_key)
         self.public_key = params.get("public_key", "")
+        if self.public_key.startswith("~/"):
+            self.public_key = os.path.expanduser(self.public_key)
         self.keyless_signer_id = params.get("keyless_signer_id", "")
+        self.workers = params.get("workers", 0)
+        self.hash_pool = params.get("hash_pool", common.HASH_POOL_THREAD)
+        self.paranoid = params.get("paranoid", False)
+        self.digest_cache_dir = params.get("digest_cache_dir", "")
+        self.cosign_path = params.get("cosign_path", "")
+        self.cosign_sha256 = params.get("cosign_sha256", "")
+        self.workspace = common.Workspace()
+        self.metrics = metrics_util.Metrics()
+        self.digest_mode = params.get("digest_mode", common.DIGEST_MODE_SHA256)
+        self.incremental = params.get("incremental", False)
+        self.merkle = params.get("merkle", False)
+        self.lfs_pointers = params.get("lfs_pointers", False)
+        self.scm_type = params.get("scm_type", common.SCM_TYPE_AUTO)
+        self.digest_algorithm = params.get("digest_algorithm", common.DIGEST_ALGORITHM_SHA256)
+        self.ignore = params.get("ignore", [])
+        self.sigstore_bundle = params.get("sigstore_bundle", False)
+        self.rekor_url = params.get("rekor_url", "")
+        self.fulcio_url = params.get("fulcio_url", "")
+        self.signers = params.get("signers") or []
+        self.signer_name = params.get("signer_name", "")
+
+    def digest_cache(self):
+        if self.paranoid:
+            return None
+        return common.DigestCache(self.digest_cache_dir)
 
     def sign(self):
         result = {}
-        if self.type == common.TYPE_PLAYBOOK:
-            result = self.sign_playbook()
-        else:
-            raise ValueError("type must be one of [{}]".format([common.TYPE_PLAYBOOK]))
+        with self.workspace:
+            if self.type == common.TYPE_PLAYBOOK:
+                result = self.sign_playbook()
+            else:
+                raise ValueError("type must be one of [{}]".format([common.TYPE_PLAYBOOK]))
+        result["metrics"] = self.metrics.as_dict()
         return result
 
     def sign_playbook(self):
         result = {"failed": False}
-        digester = common.Digester(self.target)
-        result["digest_result"] = digester.gen()
+        digester = common.Digester(self.target, workers=self.workers, digest_mode=self.digest_mode, cache=self.digest_cache(), merkle=self.merkle, metrics=self.metrics, lfs_pointers=self.lfs_pointers,
+                                   scm_type=self.scm_type, ignore=self.ignore, digest_algorithm=self.digest_algorithm, hash_pool=self.hash_pool)
+        try:
+            result["digest_result"] = digester.gen(incremental=self.incremental)
+        finally:
+            digester.close()
         if result["digest_result"]["returncode"] != 0:
             result["failed"] = True
             return result
 
-        if self.signature_type == common.SIGNATURE_TYPE_GPG:
-            sig_file = os.path.join(self.target, common.SIGNATURE_FILENAME_GPG)
-            if os.path.exists(sig_file):
-                os.remove(sig_file) # remove privious signature before signing
-            result["sign_result"] = self.sign_gpg(self.target, common.DIGEST_FILENAME)
-        elif self.signature_type in [common.SIGNATURE_TYPE_SIGSTORE, common.SIGNATURE_TYPE_SIGSTORE_KEYLESS]:
-            keyless = True if self.signature_type == common.SIGNATURE_TYPE_SIGSTORE_KEYLESS else False
-            type = common.SIGSTORE_TARGET_TYPE_FILE
-            result["sign_result"] = self.sign_sigstore(self.target, target_type=type, keyless=keyless, filename=common.DIGEST_FILENAME)
-        else:
-            raise ValueError("this signature type is not supported: {}".format(self.signature_type))
+        if self.signers:
+            result["sign_results"] = self.sign_all()
+            result["failed"] = any([r["returncode"] != 0 for r in result["sign_results"].values()])
+            return result
+
+        result["sign_result"] = self.sign_digest_file()
         if result["sign_result"]["returncode"] != 0:
             result["failed"] = True
             return result
 
         return result
 
-    def sign_gpg(self, path, filename):
-        if self.private_key != "":
-            raise ValueError("using a specific private key is not supported yet")
+    # signs the one digest file with every entry of "signers" concurrently, each into its own signature file
+    def sign_all(self):
+        signers = [Signer(params) for params in common.signer_params(self.params)]
+        for signer in signers:
+            signer.workspace = self.workspace
+            signer.metrics = self.metrics
 
+        def sign_one(signer):
+            try:
+                return signer.sign_digest_file()
+            except ValueError as e:
+                return dict(returncode=1, stdout="", stderr=str(e))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(signers)) as executor:
+            results = list(executor.map(sign_one, signers))
+        return dict((signer.signer_name, result) for signer, result in zip(signers, results))
+
+    def sign_digest_file(self):
+        sigfile = common.signature_filename(self.signer_name)
+        if self.signature_type == common.SIGNATURE_TYPE_GPG:
+            sig_file = os.path.join(self.target, sigfile)
+            if os.path.exists(sig_file):
+                os.remove(sig_file) # remove privious signature before signing
+            with self.metrics.phase(metrics_util.PHASE_SIGN):
+                return self.sign_gpg(self.target, common.DIGEST_FILENAME, sigfile=sigfile)
+        elif self.signature_type in [common.SIGNATURE_TYPE_SIGSTORE, common.SIGNATURE_TYPE_SIGSTORE_KEYLESS]:
+            keyless = True if self.signature_type == common.SIGNATURE_TYPE_SIGSTORE_KEYLESS else False
+            with self.metrics.phase(metrics_util.PHASE_SIGN):
+                return self.sign_sigstore_file(self.target, filename=common.DIGEST_FILENAME, keyless=keyless, sigfile=sigfile)
+        raise ValueError("this signature type is not supported: {}".format(self.signature_type))
+
+    # `private_key` of a gpg signer is the key id or user id of a secret key in the keyring
+    def sign_gpg(self, path, filename, sigfile=common.SIGNATURE_FILENAME_GPG):
         if not os.path.exists(path):
             raise ValueError("the directory \"{}\" does not exists".format(path))
 
-        cmd = "cd {}; gpg --detach-sign {}".format(path, filename)
-        result = common.execute_command(cmd)
+        argv = ["gpg", "--detach-sign"]
+        if self.private_key != "":
+            argv += ["--local-user", self.private_key]
+        if sigfile != common.SIGNATURE_FILENAME_GPG:
+            argv += ["--output", sigfile]
+        result = common.run_command(argv + [filename], cwd=path, metrics=self.metrics)
         return result
 
     def sign_sigstore(self, target, target_type=common.SIGSTORE_TARGET_TYPE_FILE, keyless=False, filename=common.DIGEST_FILENAME):
@@ -70,19 +137,30 @@ class Signer:
         if not os.path.exists(path):
             raise ValueError("the directory \"{}\" does not exists".format(path))
         
-        cosign_cmd = common.get_cosign_path()
-        output_option = "--output-signature {}".format(sigfile)
-        experimental_option=""
-        key_option = ""
-        idtoken_option = ""
+        with self.metrics.phase(metrics_util.PHASE_COSIGN):
+            cosign = common.resolve_cosign(cosign_path=self.cosign_path, cosign_sha256=self.cosign_sha256, allow_download=True, cache_dir=self.digest_cache_dir, workspace=self.workspace)
+        argv = [cosign["path"], "sign-blob"]
+        env_params = None
         if keyless:
-            experimental_option = "COSIGN_EXPERIMENTAL=1"
-            idtoken_option = "--identity-token {}".format(self.keyless_signer_id)
+            env_params = {"COSIGN_EXPERIMENTAL": "1"}
+            argv += ["--identity-token", self.keyless_signer_id]
         else:
-            key_option = "--key {}".format(self.private_key)
-
-        cmd = "cd {}; {} {} sign-blob {} {} {} {}".format(path, experimental_option, cosign_cmd, key_option, idtoken_option, output_option, filename)
-        result = common.execute_command(cmd)
+            argv += ["--key", self.private_key]
+        if self.rekor_url:
+            argv += ["--rekor-url", self.rekor_url]
+        if self.fulcio_url:
+            argv += ["--fulcio-url", self.fulcio_url]
+        # the bundle holds the signature, the certificate and the transparency log entry with its inclusion proof
+        if self.sigstore_bundle:
+            sigstore.require_bundle_support(cosign)
+            bundle = sigstore.bundle_filename(self.signer_name)
+            bundle_file = os.path.join(path, bundle)
+            if os.path.exists(bundle_file):
+                os.remove(bundle_file)
+            argv += ["--yes", "--bundle", bundle]
+        argv += ["--output-signature", sigfile, filename]
+        result = common.run_command(argv, cwd=path, env_params=env_params, metrics=self.metrics)
+        result["cosign"] = cosign
         return result        
 
 
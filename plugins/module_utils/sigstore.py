@@ -0,0 +1,114 @@
+import fcntl
+import os
+import time
+import ansible_collections.playbook.integrity.plugins.module_utils.common as common
+
+
+SIGNATURE_FILENAME_BUNDLE = "sha256sum.txt.bundle"
+
+# cosign keeps its TUF metadata (fulcio roots, rekor and ctlog keys) in $TUF_ROOT
+TRUST_ROOT_DIRNAME = "sigstore-root"
+TRUST_ROOT_STAMP_FILENAME = ".refreshed"
+TRUST_ROOT_DEFAULT_MAX_AGE = 24 * 60 * 60
+
+BUNDLE_MIN_COSIGN_MAJOR = 2
+
+# verification material for a private sigstore instance, e.g. a local rekor / fulcio stand-in
+ENV_REKOR_PUBLIC_KEY = "SIGSTORE_REKOR_PUBLIC_KEY"
+ENV_FULCIO_ROOT = "SIGSTORE_ROOT_FILE"
+ENV_CT_LOG_PUBLIC_KEY = "SIGSTORE_CT_LOG_PUBLIC_KEY_FILE"
+
+
+def bundle_filename(signer_name=""):
+    if not signer_name:
+        return SIGNATURE_FILENAME_BUNDLE
+    return "{}.{}.bundle".format(common.DIGEST_FILENAME, signer_name)
+
+
+def cosign_major_version(cosign):
+    version = cosign.get("version", "").lstrip("v")
+    try:
+        return int(version.split(".")[0])
+    except ValueError:
+        return None
+
+
+# `cosign` is a resolve_cosign() result; a binary whose version is unknown is given the benefit of the doubt
+def require_bundle_support(cosign):
+    major = cosign_major_version(cosign)
+    if major is not None and major < BUNDLE_MIN_COSIGN_MAJOR:
+        raise ValueError("sigstore bundles require cosign v{} or later, but \"{}\" is {}; set cosign_path to a newer binary".format(
+            BUNDLE_MIN_COSIGN_MAJOR, cosign["path"], cosign["version"]))
+
+
+def sigstore_env(rekor_public_key="", fulcio_root="", ct_log_public_key=""):
+    env = {}
+    for name, value in [(ENV_REKOR_PUBLIC_KEY, rekor_public_key), (ENV_FULCIO_ROOT, fulcio_root), (ENV_CT_LOG_PUBLIC_KEY, ct_log_public_key)]:
+        if value:
+            env[name] = os.path.expanduser(value)
+    return env
+
+
+# the sigstore TUF trust root cached under the cache dir and shared by all invocations on the host.
+# it is refreshed with "cosign initialize" once it is older than `max_age` seconds (0 never refreshes an
+# initialized root); if refreshing fails, e.g. on a disconnected node, the cached root keeps being used.
+class TrustRoot:
+    def __init__(self, cache_dir="", mirror="", root="", max_age=TRUST_ROOT_DEFAULT_MAX_AGE):
+        cache_dir = cache_dir or common.default_cache_dir()
+        if cache_dir.startswith("~/"):
+            cache_dir = os.path.expanduser(cache_dir)
+        self.dir = os.path.join(cache_dir, TRUST_ROOT_DIRNAME)
+        self.stamp_file = os.path.join(self.dir, TRUST_ROOT_STAMP_FILENAME)
+        self.lock_file = "{}.lock".format(self.dir)
+        self.mirror = mirror
+        self.root = os.path.expanduser(root) if root else ""
+        self.max_age = max_age
+
+    def env(self):
+        return {"TUF_ROOT": self.dir}
+
+    # seconds since the last successful refresh, or None if the trust root has never been initialized
+    def age(self):
+        try:
+            return max(0.0, time.time() - os.stat(self.stamp_file).st_mtime)
+        except OSError:
+            return None
+
+    def is_stale(self):
+        age = self.age()
+        return age is None or (self.max_age > 0 and age > self.max_age)
+
+    def refresh(self, cosign_path, metrics=None):
+        argv = [cosign_path, "initialize"]
+        if self.mirror:
+            argv += ["--mirror", self.mirror]
+        if self.root:
+            argv += ["--root", self.root]
+        result = common.run_command(argv, env_params=self.env(), metrics=metrics)
+        if result["returncode"] == 0:
+            with open(self.stamp_file, "w"):
+                pass
+        return result
+
+    # returns the trust root status; raises ValueError if there is no usable trust root
+    def ensure(self, cosign_path, metrics=None):
+        status = dict(path=self.dir, refreshed=False)
+        if self.is_stale():
+            os.makedirs(os.path.dirname(self.dir), mode=0o700, exist_ok=True)
+            fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                # another invocation may have refreshed it while this one waited for the lock
+                if self.is_stale():
+                    os.makedirs(self.dir, mode=0o700, exist_ok=True)
+                    result = self.refresh(cosign_path, metrics=metrics)
+                    if result["returncode"] == 0:
+                        status["refreshed"] = True
+                    elif self.age() is None:
+                        raise ValueError("no cached sigstore trust root in \"{}\" and initializing it failed; {}".format(self.dir, result["stderr"]))
+                    else:
+                        status["refresh_error"] = result["stderr"]
+            finally:
+                os.close(fd)
+        status["age"] = round(self.age(), 3)
+        return status
@@ -1,43 +1,449 @@
 
+import fcntl
+import hashlib
+import hmac
+import json
 import os
+import shutil
+import socket
 import subprocess
+import tempfile
+import threading
+import time
 import ansible_collections.playbook.integrity.plugins.module_utils.common as common
+import ansible_collections.playbook.integrity.plugins.module_utils.metrics as metrics_util
+import ansible_collections.playbook.integrity.plugins.module_utils.pipeline as pipeline
+import ansible_collections.playbook.integrity.plugins.module_utils.sigstore as sigstore
+
+
+GPG_STATUS_PREFIX = "[GNUPG:] "
+GPG_STATUS_VALIDSIG = "VALIDSIG"
+GPG_SESSION_DIRNAME = "gpg"
+
+VERDICT_CACHE_FILENAME = "verdict-cache.json"
+VERDICT_CACHE_KEY_FILENAME = "verdict-cache.key"
+VERDICT_CACHE_MAX_ENTRIES = 1000
+VERDICT_CACHE_DEFAULT_TTL = 3600
+
+# see verifyd.py
+DAEMON_PROTOCOL_VERSION = 1
+DAEMON_SOCKET_FILENAME = "verifyd.sock"
+DAEMON_TIMEOUT = 600
+DAEMON_READ_SIZE = 64 * 1024
+
+# how many of the signatures of "signers" must be valid
+SIGNATURE_POLICY_ALL = "all"
+SIGNATURE_POLICY_ANY = "any"
+SIGNATURE_POLICY_THRESHOLD = "k-of-n"
+SIGNATURE_POLICIES = [SIGNATURE_POLICY_ALL, SIGNATURE_POLICY_ANY, SIGNATURE_POLICY_THRESHOLD]
+
+_gpg_sessions = {}
+_gpg_sessions_lock = threading.Lock()
+
+
+def required_signatures(policy, threshold, total):
+    if policy == SIGNATURE_POLICY_ALL:
+        return total
+    if policy == SIGNATURE_POLICY_ANY:
+        return 1
+    if policy == SIGNATURE_POLICY_THRESHOLD:
+        if not threshold or threshold < 1 or threshold > total:
+            raise ValueError("signature_threshold must be between 1 and the number of signers ({}) for the \"{}\" policy".format(total, policy))
+        return threshold
+    raise ValueError("signature_policy must be one of {}".format(SIGNATURE_POLICIES))
+
+
+# the overall signature verdict of a policy over the results of the signers' checks
+def signature_policy_result(policy, required, signatures):
+    passed = sorted([name for name, result in signatures.items() if result["returncode"] == 0])
+    failed = sorted([name for name, result in signatures.items() if result["returncode"] != 0 and not result.get("cancelled", False)])
+    result = dict(returncode=0, stdout="", stderr="", policy=policy, required=required, passed=passed, failed=failed)
+    if len(passed) < required:
+        result["returncode"] = 1
+        result["stderr"] = "{} of {} required signatures are valid".format(len(passed), required)
+        if len(failed) > 0:
+            result["stderr"] += "; failed: {}".format(", ".join(failed))
+    return result
+
+
+# a GNUPGHOME with the public keyring imported once, cached on disk by the sha256 of the keyring file
+# and in-process per keyring, so verifying many targets does not re-import / re-parse the keyring.
+class GPGVerifySession:
+    def __init__(self, publickey="", cache_dir="", keyring_digest=""):
+        self.publickey = publickey
+        self.gnupghome = None
+        if publickey != "":
+            if keyring_digest == "":
+                keyring_digest = common.sha256_file(publickey)
+            cache_dir = cache_dir or common.default_cache_dir()
+            if cache_dir.startswith("~/"):
+                cache_dir = os.path.expanduser(cache_dir)
+            base_dir = os.path.join(cache_dir, GPG_SESSION_DIRNAME)
+            self.gnupghome = os.path.join(base_dir, "gpghome-{}".format(keyring_digest[:32]))
+            if not os.path.isdir(self.gnupghome):
+                self.import_keyring(base_dir)
+
+    def import_keyring(self, base_dir):
+        os.makedirs(base_dir, mode=0o700, exist_ok=True)
+        tmp_home = tempfile.mkdtemp(dir=base_dir, prefix=".gpghome-")
+        argv = ["gpg", "--batch", "--no-autostart", "--quiet", "--import", self.publickey]
+        result = common.run_command(argv, env_params={"GNUPGHOME": tmp_home})
+        if result["returncode"] != 0:
+            shutil.rmtree(tmp_home, ignore_errors=True)
+            raise ValueError("failed to import the public key \"{}\"; {}".format(self.publickey, result["stderr"]))
+        try:
+            os.rename(tmp_home, self.gnupghome)
+        except OSError:
+            # another process has imported the same keyring in the meantime
+            shutil.rmtree(tmp_home, ignore_errors=True)
+
+    def verify(self, sigfile, msgfile):
+        result = common.run_command(**self.verify_command(sigfile, msgfile))
+        return self.check_result(result)
+
+    def verify_command(self, sigfile, msgfile):
+        env_params = None
+        if self.gnupghome is not None:
+            env_params = {"GNUPGHOME": self.gnupghome}
+        argv = ["gpg", "--batch", "--no-autostart", "--status-fd", "1", "--verify", sigfile, msgfile]
+        return dict(argv=argv, env_params=env_params)
+
+    def check_result(self, result):
+        status = [line[len(GPG_STATUS_PREFIX):] for line in result["stdout"].splitlines() if line.startswith(GPG_STATUS_PREFIX)]
+        if result["returncode"] == 0 and not any(line.startswith(GPG_STATUS_VALIDSIG + " ") for line in status):
+            result["returncode"] = 1
+            result["stderr"] = "{}no valid signature found in gpg status output\n".format(result["stderr"])
+        result["status"] = status
+        return result
+
+
+def get_gpg_session(publickey="", cache_dir=""):
+    keyring_digest = common.sha256_file(publickey) if publickey != "" else ""
+    key = (publickey, keyring_digest, cache_dir)
+    with _gpg_sessions_lock:
+        session = _gpg_sessions.get(key)
+        if session is None:
+            session = GPGVerifySession(publickey, cache_dir=cache_dir, keyring_digest=keyring_digest)
+            _gpg_sessions[key] = session
+    return session
+
+
+def default_daemon_socket():
+    return os.path.join(common.default_cache_dir(), DAEMON_SOCKET_FILENAME)
+
+
+# returns the verifier daemon's result for `params`; raises OSError if it cannot be reached and ValueError on errors
+def query_verifier_daemon(socket_path, params, timeout=DAEMON_TIMEOUT):
+    request = json.dumps(dict(version=DAEMON_PROTOCOL_VERSION, params=params)).encode("utf-8") + b"\n"
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(os.path.expanduser(socket_path))
+        sock.sendall(request)
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = sock.recv(DAEMON_READ_SIZE)
+            if chunk == b"":
+                raise ValueError("the verifier daemon closed the connection")
+            data += chunk
+    response = json.loads(data.decode("utf-8"))
+    if "error" in response:
+        raise ValueError("the verifier daemon failed; {}".format(response["error"]))
+    return response["result"]
+
+
+# on-disk cache of successful signature checks, keyed by (HEAD commit, sha256 of the digest file,
+# sha256 of its signature, signature type, signer) with TTL and LRU eviction.
+# every entry carries an HMAC with a per-user secret key, so entries modified on disk are ignored.
+class VerdictCache:
+    def __init__(self, cache_dir="", ttl=VERDICT_CACHE_DEFAULT_TTL, max_entries=VERDICT_CACHE_MAX_ENTRIES):
+        self.cache_dir = cache_dir or common.default_cache_dir()
+        if self.cache_dir.startswith("~/"):
+            self.cache_dir = os.path.expanduser(self.cache_dir)
+        self.cache_file = os.path.join(self.cache_dir, VERDICT_CACHE_FILENAME)
+        self.lock_file = "{}.lock".format(self.cache_file)
+        self.secret_file = os.path.join(self.cache_dir, VERDICT_CACHE_KEY_FILENAME)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.secret = None
+
+    def _open_lock(self, operation):
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, operation)
+        return fd
+
+    def _secret(self):
+        if self.secret is None:
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+            try:
+                fd = os.open(self.secret_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                with os.fdopen(fd, "wb") as f:
+                    f.write(os.urandom(32))
+            except FileExistsError:
+                pass
+            with open(self.secret_file, "rb") as f:
+                self.secret = f.read()
+            if len(self.secret) < 32:
+                raise ValueError("the verdict cache key \"{}\" is too short".format(self.secret_file))
+        return self.secret
+
+    def _mac(self, key, created, verdict):
+        msg = json.dumps([key, created, verdict], sort_keys=True, separators=(",", ":")).encode("utf-8")
+        return hmac.new(self._secret(), msg, hashlib.sha256).hexdigest()
+
+    def _read(self):
+        try:
+            with open(self.cache_file, "r") as f:
+                entries = json.load(f)
+            if isinstance(entries, dict):
+                return entries
+        except (OSError, ValueError):
+            pass
+        return {}
+
+    @staticmethod
+    def key(head, manifest_sha256, sig_sha256, signature_type, signer):
+        return hashlib.sha256(json.dumps([head, manifest_sha256, sig_sha256, signature_type, signer]).encode("utf-8")).hexdigest()
+
+    def lookup(self, key):
+        fd = self._open_lock(fcntl.LOCK_SH)
+        try:
+            entry = self._read().get(key)
+        finally:
+            os.close(fd)
+        if not isinstance(entry, dict) or time.time() - entry.get("created", 0) > self.ttl:
+            return None
+        if not hmac.compare_digest(str(entry.get("mac", "")), self._mac(key, entry.get("created"), entry.get("verdict"))):
+            return None
+        return entry["verdict"]
+
+    def store(self, key, verdict):
+        fd = self._open_lock(fcntl.LOCK_EX)
+        try:
+            now = time.time()
+            entries = self._read()
+            entries.pop(key, None)
+            entries = dict((k, e) for k, e in entries.items() if isinstance(e, dict) and now - e.get("created", 0) <= self.ttl)
+            entries[key] = dict(created=now, verdict=verdict, mac=self._mac(key, now, verdict))
+            # dicts keep the insertion order, so the oldest entries come first
+            while len(entries) > self.max_entries:
+                entries.pop(next(iter(entries)))
+            tmp_fd, tmp_file = tempfile.mkstemp(dir=self.cache_dir, prefix=".{}.".format(VERDICT_CACHE_FILENAME))
+            with os.fdopen(tmp_fd, "w") as f:
+                json.dump(entries, f, separators=(",", ":"))
+            os.replace(tmp_file, self.cache_file)
+        finally:
+            os.close(fd)
 
 
 class Verifier:
     def __init__(self, params):
+        self.params = params
         self.type = params.get("type", "")
         self.target = params.get("target", "")
         if self.target.startswith("~/"):
             self.target = os.path.expanduser(self.target)
         self.signature_type = params.get("signature_type", "gpg")
         self.public_key = params.get("public_key", "")
+        if self.public_key.startswith("~/"):
+            self.public_key = os.path.expanduser(self.public_key)
         self.keyless_signer_id = params.get("keyless_signer_id", "")
+        self.workers = params.get("workers", 0)
+        self.hash_pool = params.get("hash_pool", common.HASH_POOL_THREAD)
+        self.paths = params.get("paths", None)
+        self.paranoid = params.get("paranoid", False)
+        self.digest_cache_dir = params.get("digest_cache_dir", "")
+        self.cosign_path = params.get("cosign_path", "")
+        self.cosign_sha256 = params.get("cosign_sha256", "")
+        self.concurrent_stages = params.get("concurrent_stages", True)
+        self.verdict_cache_ttl = params.get("verdict_cache_ttl", VERDICT_CACHE_DEFAULT_TTL)
+        self.max_reported_differences = params.get("max_reported_differences", common.DIFF_MAX_REPORTED)
+        self.scm_type = params.get("scm_type", common.SCM_TYPE_AUTO)
+        self.digest_algorithm = params.get("digest_algorithm", "")
+        self.sigstore_bundle = params.get("sigstore_bundle", False)
+        self.keyless_oidc_issuer = params.get("keyless_oidc_issuer", "")
+        self.tuf_mirror = params.get("tuf_mirror", "")
+        self.tuf_root = params.get("tuf_root", "")
+        self.trust_root_max_age = params.get("trust_root_max_age", sigstore.TRUST_ROOT_DEFAULT_MAX_AGE)
+        self.rekor_public_key = params.get("rekor_public_key", "")
+        self.fulcio_root = params.get("fulcio_root", "")
+        self.ct_log_public_key = params.get("ct_log_public_key", "")
+        self.daemon_socket = params.get("daemon_socket", "")
+        self.signers = params.get("signers") or []
+        self.signer_name = params.get("signer_name", "")
+        self.signature_policy = params.get("signature_policy", SIGNATURE_POLICY_ALL)
+        self.signature_threshold = params.get("signature_threshold", None)
+        self.workspace = common.Workspace()
+        self.metrics = metrics_util.Metrics()
+
+    def digest_cache(self):
+        if self.paranoid:
+            return None
+        return common.DigestCache(self.digest_cache_dir)
+
+    def verdict_cache(self):
+        if self.paranoid or not self.verdict_cache_ttl or self.verdict_cache_ttl <= 0:
+            return None
+        return VerdictCache(self.digest_cache_dir, ttl=self.verdict_cache_ttl)
+
+    # the verdict cache key of the current digest file and signature, or None if the signer cannot be identified
+    def verdict_key(self, head):
+        if self.signature_type == common.SIGNATURE_TYPE_SIGSTORE_KEYLESS:
+            signer = "keyless:{}:{}".format(self.keyless_signer_id, self.keyless_oidc_issuer)
+        elif self.public_key != "" and os.path.isfile(self.public_key):
+            # keys in the default keyring may be revoked or replaced without notice
+            signer = "key:{}".format(common.sha256_file(self.public_key))
+        else:
+            return None
+        sigfile = os.path.join(self.target, common.signature_filename(self.signer_name))
+        if self.signature_type != common.SIGNATURE_TYPE_GPG and self.sigstore_bundle:
+            sigfile = os.path.join(self.target, sigstore.bundle_filename(self.signer_name))
+        digest_file = os.path.join(self.target, common.DIGEST_FILENAME)
+        if not os.path.isfile(sigfile) or not os.path.isfile(digest_file):
+            return None
+        return VerdictCache.key(head, common.sha256_file(digest_file), common.sha256_file(sigfile), self.signature_type, signer)
 
     def verify(self):
         result = {}
-        if self.type == common.TYPE_PLAYBOOK:
-            result = self.verify_playbook()
-        else:
-            raise ValueError("type must be one of [{}]".format([common.TYPE_PLAYBOOK]))
+        daemon_error = None
+        # paranoid verification hashes every file itself, so the daemon's watched state is not asked either
+        if self.type == common.TYPE_PLAYBOOK and self.daemon_socket and not self.paranoid:
+            try:
+                result = query_verifier_daemon(self.daemon_socket, self.params)
+                result["metrics"] = self.metrics.as_dict()
+                return result
+            except (OSError, ValueError) as e:
+                # no daemon is running or it could not answer; verify in this process instead
+                daemon_error = str(e)
+        with self.workspace:
+            if self.type == common.TYPE_PLAYBOOK:
+                result = self.verify_playbook()
+            else:
+                raise ValueError("type must be one of [{}]".format([common.TYPE_PLAYBOOK]))
+        if daemon_error is not None:
+            result["daemon"] = dict(error=daemon_error)
+        result["metrics"] = self.metrics.as_dict()
         return result
 
     def verify_playbook(self):
+        digester = common.Digester(self.target, workers=self.workers, cache=self.digest_cache(), metrics=self.metrics,
+                                   max_reported=self.max_reported_differences, scm_type=self.scm_type, digest_algorithm=self.digest_algorithm,
+                                   hash_pool=self.hash_pool)
+        if digester.type == common.SCM_TYPE_ARCHIVE:
+            return self.verify_archive(digester)
+        if self.signers:
+            return self.verify_signers(digester)
+        verdict_cache = self.verdict_cache()
+        verdict_key = None
+        if verdict_cache is not None:
+            verdict_key = self.verdict_key(digester.head_commit())
+            verdict = verdict_cache.lookup(verdict_key) if verdict_key is not None else None
+            if verdict is not None:
+                # the signature has been verified before; only the working tree needs checking
+                result = {"failed": False}
+                result["digest_result"] = digester.check(paths=self.paths)
+                result["verify_result"] = dict(verdict, cached=True)
+                result["failed"] = result["digest_result"]["returncode"] != 0
+                return result
+
+        if self.concurrent_stages:
+            command, finish = self.prepare_signature_check()
+            result = pipeline.run_verification(digester, command, finish, paths=self.paths)
+        else:
+            result = self.verify_stages(digester)
+
+        verify_result = result.get("verify_result")
+        # the files may have been replaced while gpg / cosign was reading them
+        if verdict_key is not None and verify_result is not None and verify_result["returncode"] == 0 and self.verdict_key(digester.head_commit()) == verdict_key:
+            verdict_cache.store(verdict_key, verify_result)
+        return result
+
+    # the signature is checked on the digest file copied out of the archive while its files were hashed
+    def verify_archive(self, digester):
         result = {"failed": False}
-        digester = common.Digester(self.target)
-        result["digest_result"] = digester.check()
+        keep_dir = self.workspace.path("archive")
+        result["digest_result"] = digester.check_archive(paths=self.paths, keep_dir=keep_dir)
         if result["digest_result"]["returncode"] != 0:
             result["failed"] = True
             return result
 
-        if self.signature_type == common.SIGNATURE_TYPE_GPG:
-            result["verify_result"] = self.verify_gpg(self.target, common.SIGNATURE_FILENAME_GPG, common.DIGEST_FILENAME, self.public_key)
-        elif self.signature_type in [common.SIGNATURE_TYPE_SIGSTORE, common.SIGNATURE_TYPE_SIGSTORE_KEYLESS]:
-            keyless = True if self.signature_type == common.SIGNATURE_TYPE_SIGSTORE_KEYLESS else False
-            type = common.SIGSTORE_TARGET_TYPE_FILE
-            result["verify_result"] = self.verify_sigstore(self.target, target_type=type, keyless=keyless)
+        root = os.path.join(keep_dir, result["digest_result"]["archive"]["root"])
+        if self.signers:
+            required = required_signatures(self.signature_policy, self.signature_threshold, len(self.signers))
+            checks, failed = self.signer_checks(path=root)
+            result["signatures"] = self.run_signer_checks(checks, required, failed)
+            result["verify_result"] = signature_policy_result(self.signature_policy, required, result["signatures"])
+            result["failed"] = result["verify_result"]["returncode"] != 0
+            return result
+        with self.metrics.phase(metrics_util.PHASE_VERIFY):
+            command, finish = self.prepare_signature_check(path=root)
+            result["verify_result"] = finish(common.run_command(metrics=self.metrics, **command))
+        if result["verify_result"]["returncode"] != 0:
+            result["failed"] = True
+        return result
+
+    # checks the signatures of all "signers" against the one digest check, stopping once the policy is decided
+    def verify_signers(self, digester):
+        required = required_signatures(self.signature_policy, self.signature_threshold, len(self.signers))
+        checks, failed = self.signer_checks()
+        if self.concurrent_stages:
+            result = pipeline.run_policy_verification(digester, checks, required, self.metrics, paths=self.paths, failed=failed)
         else:
-            raise ValueError("this signature type is not supported: {}".format(self.signature_type))
+            result = {"failed": False}
+            result["digest_result"] = digester.check(paths=self.paths)
+            if result["digest_result"]["returncode"] != 0:
+                result["failed"] = True
+                return result
+            result["signatures"] = self.run_signer_checks(checks, required, failed)
+        result["verify_result"] = signature_policy_result(self.signature_policy, required, result["signatures"])
+        result["failed"] = result["digest_result"]["returncode"] != 0 or result["verify_result"]["returncode"] != 0
+        return result
+
+    # the signature check of every signer as (name, command, finish), and the results of those that cannot be checked
+    def signer_checks(self, path=None):
+        checks = []
+        failed = {}
+        for params in common.signer_params(self.params):
+            verifier = Verifier(params)
+            verifier.workspace = self.workspace
+            verifier.metrics = self.metrics
+            try:
+                command, finish = verifier.prepare_signature_check(path=path)
+            except ValueError as e:
+                failed[verifier.signer_name] = dict(returncode=1, stdout="", stderr=str(e))
+                continue
+            checks.append((verifier.signer_name, command, finish))
+        return checks, failed
+
+    # runs the signature checks one after another until the policy is decided
+    def run_signer_checks(self, checks, required, failed):
+        signatures = dict(failed)
+        total = len(checks) + len(failed)
+        for name, command, finish in checks:
+            passed = len([r for r in signatures.values() if r["returncode"] == 0])
+            if passed >= required or len(signatures) - passed > total - required:
+                signatures[name] = dict(returncode=1, stdout="", stderr="not checked because the signature policy was already decided", cancelled=True)
+                continue
+            with self.metrics.phase(metrics_util.PHASE_VERIFY):
+                signatures[name] = finish(common.run_command(metrics=self.metrics, **command))
+        return signatures
+
+    def verify_stages(self, digester):
+        result = {"failed": False}
+        result["digest_result"] = digester.check(paths=self.paths)
+        if result["digest_result"]["returncode"] != 0:
+            result["failed"] = True
+            return result
+
+        with self.metrics.phase(metrics_util.PHASE_VERIFY):
+            if self.signature_type == common.SIGNATURE_TYPE_GPG:
+                result["verify_result"] = self.verify_gpg(self.target, common.SIGNATURE_FILENAME_GPG, common.DIGEST_FILENAME, self.public_key)
+            elif self.signature_type in [common.SIGNATURE_TYPE_SIGSTORE, common.SIGNATURE_TYPE_SIGSTORE_KEYLESS]:
+                keyless = True if self.signature_type == common.SIGNATURE_TYPE_SIGSTORE_KEYLESS else False
+                type = common.SIGSTORE_TARGET_TYPE_FILE
+                result["verify_result"] = self.verify_sigstore(self.target, target_type=type, keyless=keyless)
+            else:
+                raise ValueError("this signature type is not supported: {}".format(self.signature_type))
         if result["verify_result"]["returncode"] != 0:
             result["failed"] = True
             return result
@@ -45,24 +451,31 @@ class Verifier:
         return result
 
     def verify_gpg(self, path, sigfile, msgfile, publickey=""):
+        command, finish = self.prepare_verify_gpg(path, sigfile, msgfile, publickey)
+        return finish(common.run_command(metrics=self.metrics, **command))
+
+    # returns the signature check of the configured signature type as (command, finish) without running it;
+    # `command` holds the run_command() arguments and `finish` post-processes its result.
+    def prepare_signature_check(self, path=None):
+        path = path or self.target
+        sigfile = common.signature_filename(self.signer_name)
+        if self.signature_type == common.SIGNATURE_TYPE_GPG:
+            return self.prepare_verify_gpg(path, sigfile, common.DIGEST_FILENAME, self.public_key)
+        elif self.signature_type in [common.SIGNATURE_TYPE_SIGSTORE, common.SIGNATURE_TYPE_SIGSTORE_KEYLESS]:
+            keyless = True if self.signature_type == common.SIGNATURE_TYPE_SIGSTORE_KEYLESS else False
+            return self.prepare_verify_sigstore_file(path, keyless=keyless, msgfile=common.DIGEST_FILENAME, sigfile=sigfile)
+        raise ValueError("this signature type is not supported: {}".format(self.signature_type))
+
+    def prepare_verify_gpg(self, path, sigfile, msgfile, publickey=""):
         if not os.path.exists(path):
             raise ValueError("the directory \"{}\" does not exists".format(path))
 
         if not os.path.exists(os.path.join(path, sigfile)):
             raise ValueError("signature file \"{}\" does not exists in path \"{}\"".format(sigfile, path))
-        
-        gpghome_option = ""
-        keyring_option = ""
-        if publickey != "":
-            try:
-                os.makedirs(common.TMP_GNUPG_HOME_DIR)
-            except Exception:
-                pass
-            gpghome_option = "GNUPGHOME={}".format(common.TMP_GNUPG_HOME_DIR)
-            keyring_option = "--no-default-keyring --keyring {}".format(publickey)
-        cmd = "cd {}; {} gpg --verify {} {} {}".format(path, gpghome_option, keyring_option, sigfile, msgfile)
-        result = common.execute_command(cmd)
-        return result
+
+        session = get_gpg_session(publickey, cache_dir=self.digest_cache_dir)
+        command = session.verify_command(os.path.join(path, sigfile), os.path.join(path, msgfile))
+        return command, session.check_result
 
     def verify_sigstore(self, target, target_type=common.SIGSTORE_TARGET_TYPE_FILE, keyless=False):
         result = None
@@ -73,19 +486,65 @@ class Verifier:
         return result
 
     def verify_sigstore_file(self, path, keyless=False, msgfile=common.DIGEST_FILENAME, sigfile=common.SIGNATURE_FILENAME_SIGSTORE):
+        command, finish = self.prepare_verify_sigstore_file(path, keyless=keyless, msgfile=msgfile, sigfile=sigfile)
+        return finish(common.run_command(metrics=self.metrics, **command))
+
+    def prepare_verify_sigstore_file(self, path, keyless=False, msgfile=common.DIGEST_FILENAME, sigfile=common.SIGNATURE_FILENAME_SIGSTORE):
+        if self.sigstore_bundle:
+            return self.prepare_verify_sigstore_bundle(path, keyless=keyless, msgfile=msgfile, bundle=sigstore.bundle_filename(self.signer_name))
         if not os.path.exists(path):
             raise ValueError("the directory \"{}\" does not exists".format(path))
 
         if not os.path.exists(os.path.join(path, sigfile)):
             raise ValueError("signature file \"{}\" does not exists in path \"{}\"".format(sigfile, path))
         
-        cosign_cmd = common.get_cosign_path()
-        experimental_option=""
-        key_option = ""
+        with self.metrics.phase(metrics_util.PHASE_COSIGN):
+            cosign = common.resolve_cosign(cosign_path=self.cosign_path, cosign_sha256=self.cosign_sha256, allow_download=False, cache_dir=self.digest_cache_dir, workspace=self.workspace)
+        argv = [cosign["path"], "verify-blob"]
+        env_params = None
         if keyless:
-            experimental_option = "COSIGN_EXPERIMENTAL=1"
+            env_params = {"COSIGN_EXPERIMENTAL": "1"}
         else:
-            key_option = "--key {}".format(self.public_key)
-        cmd = "cd {}; {} {} verify-blob {} --signature {} {}".format(path, experimental_option, cosign_cmd, key_option, sigfile, msgfile)
-        result = common.execute_command(cmd)
-        return result
\ No newline at end of file
+            argv += ["--key", self.public_key]
+        argv += ["--signature", sigfile, msgfile]
+
+        def finish(result):
+            result["cosign"] = cosign
+            return result
+        return dict(argv=argv, cwd=path, env_params=env_params), finish
+
+    # verifies the signature bundle offline: the certificate chain, the signed entry timestamp and the
+    # inclusion proof are checked against the cached trust root, without contacting fulcio / rekor / TUF
+    def prepare_verify_sigstore_bundle(self, path, keyless=False, msgfile=common.DIGEST_FILENAME, bundle=sigstore.SIGNATURE_FILENAME_BUNDLE):
+        if not os.path.exists(path):
+            raise ValueError("the directory \"{}\" does not exists".format(path))
+
+        if not os.path.exists(os.path.join(path, bundle)):
+            raise ValueError("signature bundle \"{}\" does not exists in path \"{}\"".format(bundle, path))
+
+        with self.metrics.phase(metrics_util.PHASE_COSIGN):
+            cosign = common.resolve_cosign(cosign_path=self.cosign_path, cosign_sha256=self.cosign_sha256, allow_download=False, cache_dir=self.digest_cache_dir, workspace=self.workspace)
+            sigstore.require_bundle_support(cosign)
+            trust_root = sigstore.TrustRoot(self.digest_cache_dir, mirror=self.tuf_mirror, root=self.tuf_root, max_age=self.trust_root_max_age)
+            trust_root_status = trust_root.ensure(cosign["path"], metrics=self.metrics)
+        argv = [cosign["path"], "verify-blob", "--offline", "--bundle", bundle]
+        if keyless:
+            if self.keyless_signer_id:
+                argv += ["--certificate-identity", self.keyless_signer_id]
+            else:
+                argv += ["--certificate-identity-regexp", ".*"]
+            if self.keyless_oidc_issuer:
+                argv += ["--certificate-oidc-issuer", self.keyless_oidc_issuer]
+            else:
+                argv += ["--certificate-oidc-issuer-regexp", ".*"]
+        else:
+            argv += ["--key", self.public_key]
+        argv += [msgfile]
+        env_params = trust_root.env()
+        env_params.update(sigstore.sigstore_env(self.rekor_public_key, self.fulcio_root, self.ct_log_public_key))
+
+        def finish(result):
+            result["cosign"] = cosign
+            result["trust_root"] = trust_root_status
+            return result
+        return dict(argv=argv, cwd=path, env_params=env_params), finish
@@ -0,0 +1,417 @@
+import argparse
+import copy
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import json
+import os
+import signal
+import socket
+import socketserver
+import stat
+import struct
+import sys
+import threading
+import time
+import ansible_collections.playbook.integrity.plugins.module_utils.common as common
+import ansible_collections.playbook.integrity.plugins.module_utils.dirwalk as dirwalk
+import ansible_collections.playbook.integrity.plugins.module_utils.manifest as manifest
+import ansible_collections.playbook.integrity.plugins.module_utils.verify as verify
+
+
+# A long-running verifier for hosts that verify the same targets again and again.
+#
+# A target is verified in full (signature and every file) on its first request. The daemon then watches the
+# target with inotify, and later requests with the same params only re-hash the files changed since, so a
+# clean tree is answered without reading it again. A change to the digest file or a signature, a new HEAD
+# commit, a moved directory or an overflowing event queue falls back to a full verification, and so does
+# any difference from the digest file, so that failures are reported exactly like an in-process run.
+# Changes inotify cannot see (e.g. made by another host on a network filesystem) are only noticed by the
+# full verification every `max_age` seconds.
+#
+#   $ python3 -m ansible_collections.playbook.integrity.plugins.module_utils.verifyd --socket ~/.cache/playbook-integrity/verifyd.sock
+
+DEFAULT_MAX_AGE = 3600
+DRAIN_INTERVAL = 1.0
+
+# params that do not change the outcome of a verification
+UNKEYED_PARAMS = ["daemon_socket", "metrics_file", "metrics_format", "action", "run_on", "targets", "max_parallel_targets", "compare_remote_manifest"]
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+EVENT_HEADER = struct.Struct("iIII")
+EVENT_READ_SIZE = 64 * 1024
+
+
+class Inotify:
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available on this platform")
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, "{}: {}".format(path, os.strerror(e)))
+        return wd
+
+    # returns the queued (wd, mask, name) events without blocking
+    def read_events(self):
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, EVENT_READ_SIZE)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                events.append((wd, mask, name))
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def public_key_sha256(public_key):
+    public_key = os.path.expanduser(public_key or "")
+    if public_key != "" and os.path.isfile(public_key):
+        return common.sha256_file(public_key)
+    return ""
+
+
+# the key of a verification request; the public keys are keyed by content since they may be replaced in place
+def request_key(params):
+    key = dict((k, v) for k, v in params.items() if k not in UNKEYED_PARAMS)
+    key["target"] = os.path.realpath(os.path.expanduser(params.get("target") or ""))
+    key["public_key_sha256"] = public_key_sha256(params.get("public_key"))
+    key["signer_public_key_sha256"] = [public_key_sha256(signer.get("public_key")) for signer in params.get("signers") or []]
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+# the integrity state of one verified target, kept up to date from inotify events
+class WatchedTarget:
+    def __init__(self, params, workers=0):
+        self.root = os.path.realpath(os.path.expanduser(params["target"]))
+        self.paths = params.get("paths", None)
+        self.lock = threading.Lock()
+        self.digester = common.Digester(self.root, workers=workers, scm_type=params.get("scm_type", common.SCM_TYPE_AUTO))
+        self.head = self.git_head()
+        self.dirs = {}
+        self.dirty = set()
+        self.invalid = None
+        self.result = None
+        self.verified = 0.0
+        self.signed = {}
+        self.current = {}
+        self.mismatched = set()
+        self.incremental = False
+        self.ignore = []
+        # watches are added before the verification, so changes made while it runs are not missed
+        self.inotify = Inotify()
+        try:
+            self.watch_tree("")
+        except OSError:
+            self.close()
+            raise
+
+    def git_head(self):
+        if self.digester.type != common.SCM_TYPE_GIT:
+            return ""
+        result = common.run_command(["git", "rev-parse", "--verify", "-q", "HEAD"], cwd=self.root)
+        return result["stdout"].strip() if result["returncode"] == 0 else ""
+
+    # adds a watch for every directory under `rel_dir` except symlinks and .git; returns the files found
+    def watch_tree(self, rel_dir):
+        fnames = []
+        pending = [rel_dir]
+        while len(pending) > 0:
+            rel_dir = pending.pop()
+            wd = self.inotify.add_watch(os.path.join(self.root, rel_dir) if rel_dir else self.root)
+            self.dirs[wd] = rel_dir
+            with os.scandir(os.path.join(self.root, rel_dir) if rel_dir else self.root) as it:
+                for entry in it:
+                    rel_path = "{}/{}".format(rel_dir, entry.name) if rel_dir else entry.name
+                    if entry.is_symlink():
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name != ".git":
+                            pending.append(rel_path)
+                    else:
+                        fnames.append(rel_path)
+        return fnames
+
+    # takes over the state of a successful verification
+    def start(self, result):
+        digest_file = os.path.join(self.root, common.DIGEST_FILENAME)
+        header = manifest.read_header(digest_file)
+        algorithm = header.get(manifest.MANIFEST_HEADER_DIGEST, common.DIGEST_ALGORITHM_SHA256)
+        self.incremental = algorithm in common.DIGEST_ALGORITHMS and header.get(common.MANIFEST_HEADER_LFS) != common.MANIFEST_LFS_POINTER
+        if self.incremental:
+            self.digester.hash_engine.algorithm = algorithm
+        self.ignore = common.DIR_ALWAYS_IGNORED + json.loads(header.get(common.MANIFEST_HEADER_IGNORE) or "[]")
+        prefixes = [common.normalize_path(path) for path in self.paths] if self.paths else None
+        self.signed = dict((fname, digest.hex()) for fname, digest in manifest.Manifest.load(digest_file).items()
+                           if prefixes is None or common.is_under(fname, prefixes))
+        self.current = dict(self.signed)
+        self.result = result
+        self.verified = time.time()
+
+    def is_relevant(self, fname):
+        if self.digester.type == common.SCM_TYPE_GIT:
+            # the listed files only change with HEAD, which invalidates the state
+            return fname in self.signed
+        if common.is_manifest_file(fname) or dirwalk.is_ignored_path(fname, self.ignore):
+            return False
+        return not self.paths or common.is_under(fname, [common.normalize_path(path) for path in self.paths])
+
+    def drain(self):
+        if self.invalid is not None:
+            return
+        for wd, mask, name in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                self.invalid = "the inotify event queue overflowed"
+                return
+            rel_dir = self.dirs.get(wd)
+            if rel_dir is None:
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                del self.dirs[wd]
+                if rel_dir == "":
+                    self.invalid = "the target was moved or deleted"
+                    return
+                continue
+            rel_path = "{}/{}".format(rel_dir, name) if rel_dir else name
+            if rel_dir == "" and common.is_manifest_file(name):
+                self.invalid = "{} changed".format(name)
+                return
+            if mask & IN_ISDIR:
+                if mask & (IN_MOVED_FROM | IN_MOVED_TO):
+                    self.invalid = "the directory {} was moved".format(rel_path)
+                    return
+                if mask & IN_CREATE and name != ".git":
+                    try:
+                        self.dirty.update(self.watch_tree(rel_path))
+                    except OSError as e:
+                        self.invalid = "failed to watch {}; {}".format(rel_path, e)
+                        return
+                continue
+            self.dirty.add(rel_path)
+
+    # re-hashes the changed files that are part of the listing
+    def update(self):
+        fnames = sorted([fname for fname in self.dirty if self.is_relevant(fname)])
+        self.dirty = set()
+        if len(fnames) > 0 and not self.incremental:
+            self.invalid = "files changed and the digest file does not hold plain content digests"
+            return 0
+        present = []
+        for fname in fnames:
+            try:
+                st = os.lstat(os.path.join(self.root, fname))
+            except FileNotFoundError:
+                st = None
+            except OSError:
+                self.mismatched.add(fname)
+                continue
+            if st is not None and stat.S_ISREG(st.st_mode):
+                present.append(fname)
+            else:
+                self.current.pop(fname, None)
+                self.compare(fname)
+        for fname, hexdigest, err in self.digester.hash_engine.hash_files(self.root, present):
+            if err is not None:
+                self.current.pop(fname, None)
+                self.mismatched.add(fname)
+                continue
+            self.current[fname] = hexdigest
+            self.compare(fname)
+        return len(present)
+
+    def compare(self, fname):
+        if self.current.get(fname) == self.signed.get(fname):
+            self.mismatched.discard(fname)
+        else:
+            self.mismatched.add(fname)
+
+    # the stored verification result if the target still matches it, otherwise None
+    def answer(self, max_age):
+        if max_age > 0 and time.time() - self.verified > max_age:
+            return None
+        self.drain()
+        if self.invalid is None and self.head != self.git_head():
+            self.invalid = "HEAD changed"
+        if self.invalid is not None:
+            return None
+        rehashed = self.update()
+        if self.invalid is not None or len(self.mismatched) > 0:
+            return None
+        result = copy.deepcopy(self.result)
+        result["daemon"] = dict(watched=True, full=False, rehashed=rehashed, age=round(time.time() - self.verified, 3))
+        return result
+
+    def close(self):
+        self.inotify.close()
+        self.digester.close()
+
+
+class VerifierDaemon:
+    def __init__(self, workers=0, max_age=DEFAULT_MAX_AGE):
+        self.workers = workers
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.targets = {}
+        self.key_locks = {}
+        self.stopped = threading.Event()
+
+    def verify(self, params):
+        params = dict(params, daemon_socket="")
+        key = request_key(params)
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self.lock:
+                target = self.targets.get(key)
+            if target is not None:
+                with target.lock:
+                    result = target.answer(self.max_age)
+                if result is not None:
+                    return result
+                self.drop(key)
+            return self.verify_full(key, params)
+
+    def verify_full(self, key, params):
+        watch_error = None
+        try:
+            target = WatchedTarget(params, workers=self.workers)
+        except (OSError, ValueError) as e:
+            target = None
+            watch_error = str(e)
+        result = verify.Verifier(params).verify()
+        if target is not None and not result.get("failed", False):
+            with target.lock:
+                target.start(result)
+            with self.lock:
+                self.targets[key] = target
+        elif target is not None:
+            target.close()
+            target = None
+        result = copy.deepcopy(result)
+        result["daemon"] = dict(watched=target is not None, full=True, rehashed=0, age=0.0)
+        if watch_error is not None:
+            result["daemon"]["watch_error"] = watch_error
+        return result
+
+    def drop(self, key):
+        with self.lock:
+            target = self.targets.pop(key, None)
+        if target is not None:
+            with target.lock:
+                target.close()
+
+    # reads the inotify events in the background so that the kernel queues do not overflow between requests
+    def drain_loop(self):
+        while not self.stopped.wait(DRAIN_INTERVAL):
+            with self.lock:
+                targets = list(self.targets.values())
+            for target in targets:
+                with target.lock:
+                    if target.inotify.fd >= 0:
+                        target.drain()
+
+    def stop(self):
+        self.stopped.set()
+        with self.lock:
+            keys = list(self.targets)
+        for key in keys:
+            self.drop(key)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        creds = self.request.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+        _, uid, _ = struct.unpack("3i", creds)
+        if uid != os.getuid():
+            self.reply({"error": "permission denied for uid {}".format(uid)})
+            return
+        try:
+            request = json.loads(self.rfile.readline().decode("utf-8"))
+            if request.get("version") != verify.DAEMON_PROTOCOL_VERSION:
+                raise ValueError("unsupported protocol version: {}".format(request.get("version")))
+            self.reply({"result": self.server.daemon.verify(request["params"])})
+        except Exception as e:
+            self.reply({"error": "{}: {}".format(type(e).__name__, e)})
+
+    def reply(self, response):
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+class VerifierServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, daemon):
+        self.daemon = daemon
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        # only the owner may connect; the peer uid is checked as well
+        umask = os.umask(0o177)
+        try:
+            super(VerifierServer, self).__init__(socket_path, RequestHandler)
+        finally:
+            os.umask(umask)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="serve playbook.integrity verifications from inotify-maintained state")
+    parser.add_argument("--socket", default=verify.default_daemon_socket(), help="path of the unix socket")
+    parser.add_argument("--workers", type=int, default=0, help="number of parallel workers used to compute file digests")
+    parser.add_argument("--max-age", type=int, default=DEFAULT_MAX_AGE, help="seconds until a target is verified in full again; 0 never")
+    args = parser.parse_args()
+
+    socket_path = os.path.expanduser(args.socket)
+    os.makedirs(os.path.dirname(os.path.abspath(socket_path)), mode=0o700, exist_ok=True)
+    daemon = VerifierDaemon(workers=args.workers, max_age=args.max_age)
+    threading.Thread(target=daemon.drain_loop, daemon=True).start()
+    server = VerifierServer(socket_path, daemon)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    sys.stderr.write("listening on {}\n".format(socket_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.stop()
+        os.unlink(socket_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -27,8 +27,21 @@ options:
     target:
         description:
         - A target name of singing. Directory path for playbook signing.
-        required: true
+        - Either "target" or "targets" must be specified.
+        required: false
         type: str
+    targets:
+        description:
+        - A list of target names. Each target is signed the same way as "target" within a single module invocation, and the result contains per-target results plus a summary.
+        required: false
+        type: list
+        elements: str
+    max_parallel_targets:
+        description:
+        - Maximum number of targets processed concurrently when "targets" is specified.
+        - default: 4
+        required: false
+        type: int
     signature_type:
         description:
         - Signature type which will be used for signing. ["gpg"/"sigstore"/"sigstore_keyless"]
@@ -37,7 +50,7 @@ options:
         type: str
     private_key:
         description:
-        - A path to your private key for signing. Only when "signature_type" is "gpg" or "sigstore"
+        - With "sigstore", a path to the private key for signing. With "gpg", the key id or user id of a secret key in the keyring; if empty, the default key is used. Not used with other "signature_type" values
         required: false
         type: str
     public_key:
@@ -50,6 +63,152 @@ options:
         - A signer id of keyless singing. If specified, the signed entity can be verified without specifying signer id. Only when "signature_type" is "sigstore_keyless"
         required: false
         type: str
+    workers:
+        description:
+        - Number of parallel workers used to compute file digests. 0 means the number of CPUs on the host.
+        - default: 0
+        required: false
+        type: int
+    hash_pool:
+        description:
+        - How the "workers" hash files. ["thread"/"process"]
+        - With "thread", files are hashed in threads of the module process; hashlib releases the GIL while hashing large buffers. "process" hashes in a pool of worker processes, which can be faster for many small files where the per-file Python work holds the GIL, at the cost of starting the workers.
+        - default: "thread"
+        required: false
+        type: str
+    incremental:
+        description:
+        - If true, the digest file records the commit it was generated from, and the next signing only re-hashes the files changed since that commit ("git diff --name-status") plus the files modified in the working tree.
+        - The commit is recorded only when the working tree is clean. Otherwise, or when the recorded commit is not found, all files are hashed. Only when "digest_mode" is "sha256"
+        - default: false
+        required: false
+        type: bool
+    merkle:
+        description:
+        - If true, a directory merkle tree "sha256tree.txt" is written next to the digest file, and its root is recorded in the signed digest file header. This allows the verify module to check only some subtrees with its "paths" option.
+        - default: false
+        required: false
+        type: bool
+    lfs_pointers:
+        description:
+        - If true, files tracked by git-lfs are recorded as the sha256 of their git-lfs pointer instead of their content. A working tree holding only the pointers then verifies the same as one with the content pulled, so large lfs assets need not be fetched on the verifying host. Only with "digest_mode" "sha256"; "git-object" records the pointers anyway.
+        - default: false
+        required: false
+        type: bool
+    scm_type:
+        description:
+        - How the files to sign are listed. ["auto"/"git"/"dir"]
+        - With "git", the files in HEAD are listed with "git ls-tree". "dir" walks the target as a plain directory, e.g. a project synced from an archive or an extracted collection tarball, and lists every regular file except symlinks, ".git" directories and the patterns in "ignore". "auto" uses "git" for a git work tree and "dir" otherwise.
+        - default: "auto"
+        required: false
+        type: str
+    ignore:
+        description:
+        - Glob patterns of files and directories left out of the digest file when "scm_type" is "dir". A pattern containing "/" matches the path relative to the target, otherwise it matches the file or directory name at any depth; a trailing "/" matches only directories.
+        - The patterns are recorded in the signed digest file, so the verify module lists the same files.
+        required: false
+        type: list
+        elements: str
+    paranoid:
+        description:
+        - If true, every file is hashed and the on-disk digest cache is neither read nor updated.
+        - default: false
+        required: false
+        type: bool
+    sigstore_bundle:
+        description:
+        - If true, a self-contained signature bundle "sha256sum.txt.bundle" (signature, certificate and transparency log entry with its inclusion proof) is written next to the signature, so that the verify module can check it offline with its "sigstore_bundle" option. Only when "signature_type" is "sigstore" or "sigstore_keyless". Requires cosign v2 or later.
+        - default: false
+        required: false
+        type: bool
+    rekor_url:
+        description:
+        - The URL of the rekor transparency log, e.g. a private instance or a local stand-in. If empty, the public instance is used. Only when "signature_type" is "sigstore" or "sigstore_keyless"
+        required: false
+        type: str
+    fulcio_url:
+        description:
+        - The URL of the fulcio certificate authority, e.g. a private instance or a local stand-in. If empty, the public instance is used. Only when "signature_type" is "sigstore_keyless"
+        required: false
+        type: str
+    cosign_path:
+        description:
+        - A path to a pre-staged cosign binary, or to an offline bundle directory containing "cosign-<os>-<arch>" or "cosign". Only when "signature_type" is "sigstore" or "sigstore_keyless"
+        - If empty, cosign is looked up in PATH. If no cosign binary is found, it is downloaded.
+        required: false
+        type: str
+    cosign_sha256:
+        description:
+        - The expected sha256 digest of the cosign binary. If specified, a binary with a different digest is rejected.
+        required: false
+        type: str
+    digest_cache_dir:
+        description:
+        - A directory for cached state that lets unchanged content skip repeated work. It holds the digest cache ("digest-cache.json"), which maps (path, size, mtime, inode, ctime) of a file to its digests per algorithm (sha256, blake2b, blake3) and to the digests of git-lfs pointers; the gpg session homes ("gpg/"); the record of the verified cosign binary ("cosign.json"); the verdict cache and its HMAC key ("verdict-cache.json", "verdict-cache.key"); the sigstore TUF trust root ("sigstore-root/"); and the verdicts of the controller action plugin ("play-verdicts/").
+        - This is security-relevant state. Anyone who can write to it can make tampered files be signed or pass verification, so the directory must be private to the user running the module, must not be shared between users, and must not be group- or world-writable. Use "paranoid" to bypass the caches.
+        - default: $XDG_CACHE_HOME/playbook-integrity, or ~/.cache/playbook-integrity if XDG_CACHE_HOME is unset
+        required: false
+        type: str
+    metrics_file:
+        description:
+        - If specified, the metrics of every target (per-phase wall / cpu time, files and bytes hashed, subprocesses and peak RSS) are also written to this file, e.g. into the textfile collector directory of the Prometheus node_exporter. The metrics are always returned in the "metrics" key of each target result.
+        required: false
+        type: str
+    metrics_format:
+        description:
+        - Format of "metrics_file". ["prometheus"/"openmetrics"]
+        - default: "prometheus"
+        required: false
+        type: str
+    digest_mode:
+        description:
+        - How file digests are recorded in the digest file. ["sha256"/"git-object"]
+        - With "sha256", the content of every file is hashed. "git-object" records the git blob id of every file taken from HEAD and only re-hashes the files that git reports as modified.
+        - The verify module detects the mode from the digest file.
+        - default: "sha256"
+        required: false
+        type: str
+    digest_algorithm:
+        description:
+        - The hash algorithm of the file digests when "digest_mode" is "sha256". ["sha256"/"blake2b"/"blake3"]
+        - The "blake2b" algorithm is faster than sha256 on CPUs without sha256 instructions. "blake3" is faster still, but requires the blake3 python package on the signing and verifying hosts.
+        - The algorithm is recorded in the header of the digest file, and the verify module uses it from there. The file is still named "sha256sum.txt". A "sha256" digest file has no header unless another option needs one, so that it stays readable by "sha256sum -c".
+        - default: "sha256"
+        required: false
+        type: str
+    signers:
+        description:
+        - A list of signers, each writing its own signature of the same digest file. The digest file is generated once, and the signers sign it concurrently.
+        - Each signer writes "sha256sum.txt.<name>.sig" ("sha256sum.txt.<name>.bundle" with "sigstore_bundle"). The options of a signer override those of the task. "name" defaults to the signature type, so signers of the same type need distinct names.
+        - If empty, the task options sign into "sha256sum.txt.sig".
+        required: false
+        type: list
+        elements: dict
+        suboptions:
+            name:
+                description:
+                - The name of the signer in the signature filename. Letters, digits, "_", "." and "-".
+                type: str
+            signature_type:
+                description:
+                - Signature type of this signer. ["gpg"/"sigstore"/"sigstore_keyless"]
+                type: str
+            private_key:
+                description:
+                - The private key of this signer, as in "private_key".
+                type: str
+            public_key:
+                description:
+                - The public key of this signer, as in "public_key".
+                type: str
+            keyless_signer_id:
+                description:
+                - The identity token of this signer, as in "keyless_signer_id".
+                type: str
+            sigstore_bundle:
+                description:
+                - Whether this signer writes a signature bundle, as in "sigstore_bundle".
+                type: bool
     
 # Specify this value according to your collection
 # in format of namespace.collection.doc_fragment_name
@@ -66,6 +225,28 @@ EXAMPLES = r'''
   playbook.integrity.sign:
     type: playbook
     target: path/to/playbookrepo
+
+# Sign many playbook SCM repos in one task
+- name: Sign playbook SCM repos
+  playbook.integrity.sign:
+    type: playbook
+    targets:
+      - path/to/playbookrepo1
+      - path/to/playbookrepo2
+    max_parallel_targets: 8
+
+# Sign a playbook SCM repo with two gpg keys and a cosign key
+- name: Sign a playbook SCM repo with several signers
+  playbook.integrity.sign:
+    type: playbook
+    target: path/to/playbookrepo
+    signers:
+      - name: release
+        private_key: release@example.com
+      - name: security
+        private_key: security@example.com
+      - signature_type: sigstore
+        private_key: path/to/cosign.key
 '''
 
 RETURN = r'''
@@ -85,16 +266,46 @@ message:
 import traceback
 from ansible.module_utils.basic import AnsibleModule
 from ansible_collections.playbook.integrity.plugins.module_utils.sign import Signer
+from ansible_collections.playbook.integrity.plugins.module_utils.batch import run_targets
+from ansible_collections.playbook.integrity.plugins.module_utils.metrics import result_samples, write_metrics_file
 
 def run_module():
     # define available arguments/parameters a user can pass to the module
     module_args = dict(
         type=dict(type='str', required=False, default="playbook"),
-        target=dict(type='str', required=True),
+        target=dict(type='str', required=False),
+        targets=dict(type='list', elements='str', required=False),
+        max_parallel_targets=dict(type='int', required=False, default=4),
         signature_type=dict(type='str', required=False, default="gpg"),
         private_key=dict(type='str', required=False, default=""),
         public_key=dict(type='str', required=False, default=""),
         keyless_signer_id=dict(type='str', required=False, default=""),
+        workers=dict(type='int', required=False, default=0),
+        hash_pool=dict(type='str', required=False, default="thread"),
+        incremental=dict(type='bool', required=False, default=False),
+        merkle=dict(type='bool', required=False, default=False),
+        lfs_pointers=dict(type='bool', required=False, default=False),
+        scm_type=dict(type='str', required=False, default="auto"),
+        ignore=dict(type='list', elements='str', required=False, default=[]),
+        paranoid=dict(type='bool', required=False, default=False),
+        digest_cache_dir=dict(type='str', required=False, default=""),
+        metrics_file=dict(type='str', required=False, default=""),
+        metrics_format=dict(type='str', required=False, default="prometheus"),
+        sigstore_bundle=dict(type='bool', required=False, default=False),
+        rekor_url=dict(type='str', required=False, default=""),
+        fulcio_url=dict(type='str', required=False, default=""),
+        cosign_path=dict(type='str', required=False, default=""),
+        cosign_sha256=dict(type='str', required=False, default=""),
+        digest_mode=dict(type='str', required=False, default="sha256"),
+        digest_algorithm=dict(type='str', required=False, default="sha256"),
+        signers=dict(type='list', elements='dict', required=False, default=[], options=dict(
+            name=dict(type='str'),
+            signature_type=dict(type='str'),
+            private_key=dict(type='str'),
+            public_key=dict(type='str'),
+            keyless_signer_id=dict(type='str'),
+            sigstore_bundle=dict(type='bool'),
+        )),
     )
 
     # seed the result dict in the object
@@ -113,6 +324,8 @@ def run_module():
     # supports check mode
     module = AnsibleModule(
         argument_spec=module_args,
+        required_one_of=[["target", "targets"]],
+        mutually_exclusive=[["target", "targets"]],
         supports_check_mode=True
     )
 
@@ -125,13 +338,23 @@ def run_module():
     # manipulate or modify the state as needed (this is going to be the
     # part where your module will do what it needs to do)
 
-    signer = Signer(module.params)
-    try:
-        sign_result = signer.sign()
-    except Exception:
-        sign_result = {"failed": True}
-        sign_result["traceback"] = traceback.format_exc()
-    result['detail'] = sign_result
+    if module.params["targets"]:
+        sign_result = run_targets(module.params, module.params["targets"], lambda params: Signer(params).sign(), max_parallel=module.params["max_parallel_targets"])
+        result['detail'] = sign_result
+    else:
+        signer = Signer(module.params)
+        try:
+            sign_result = signer.sign()
+        except Exception:
+            sign_result = {"failed": True}
+            sign_result["traceback"] = traceback.format_exc()
+        result['detail'] = sign_result
+
+    if module.params["metrics_file"]:
+        try:
+            write_metrics_file(module.params["metrics_file"], result_samples("sign", module.params, sign_result), metrics_format=module.params["metrics_format"])
+        except (OSError, ValueError) as e:
+            module.warn("failed to write the metrics file \"{}\"; {}".format(module.params["metrics_file"], e))
 
     # use whatever logic you need to determine whether or not this module
     # made any modifications to your target
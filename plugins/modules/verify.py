@@ -26,9 +26,22 @@ options:
         type: str
     target:
         description:
-        - A target name of verification. Directory path for playbook verification.
-        required: true
+        - A target name of verification. Directory path for playbook verification, or the path of a tar archive (".tar", ".tar.gz", ".tar.bz2", ".tar.xz") of a signed directory.
+        - Either "target" or "targets" must be specified.
+        required: false
         type: str
+    targets:
+        description:
+        - A list of target names. Each target is verified the same way as "target" within a single module invocation, and the result contains per-target results plus a summary.
+        required: false
+        type: list
+        elements: str
+    max_parallel_targets:
+        description:
+        - Maximum number of targets processed concurrently when "targets" is specified.
+        - default: 4
+        required: false
+        type: int
     signature_type:
         description:
         - Signature type which will be used for verification. ["gpg"/"sigstore"/"sigstore_keyless"]
@@ -45,6 +58,201 @@ options:
         - A signer id of keyless verification. If specified, the signer id of the provided signature must match with this. Only when "signature_type" is "sigstore_keyless"
         required: false
         type: str
+    workers:
+        description:
+        - Number of parallel workers used to compute file digests. 0 means the number of CPUs on the host.
+        - default: 0
+        required: false
+        type: int
+    hash_pool:
+        description:
+        - How the "workers" hash files. ["thread"/"process"]
+        - With "thread", files are hashed in threads of the module process; hashlib releases the GIL while hashing large buffers. "process" hashes in a pool of worker processes, which can be faster for many small files where the per-file Python work holds the GIL, at the cost of starting the workers.
+        - default: "thread"
+        required: false
+        type: str
+    paths:
+        description:
+        - Directories or files relative to the target to be verified. If specified, only the files under these paths are checked, and their merkle tree entries are authenticated against the signed merkle root. Requires a target signed with "merkle" enabled.
+        - The signature of the digest file is verified as usual.
+        required: false
+        type: list
+        elements: str
+    concurrent_stages:
+        description:
+        - If true, the signature of the digest file is verified while the files are hashed, and the verification stops as soon as either of them fails.
+        - default: true
+        required: false
+        type: bool
+    paranoid:
+        description:
+        - If true, every file is hashed and the on-disk digest and verdict caches are neither read nor updated.
+        - default: false
+        required: false
+        type: bool
+    sigstore_bundle:
+        description:
+        - If true, the signature bundle "sha256sum.txt.bundle" written by the sign module with "sigstore_bundle" is verified offline against the cached sigstore trust root, without contacting fulcio, rekor or the TUF repository. Only when "signature_type" is "sigstore" or "sigstore_keyless". Requires cosign v2 or later.
+        - default: false
+        required: false
+        type: bool
+    keyless_oidc_issuer:
+        description:
+        - The OIDC issuer of the signer's certificate. If empty, any issuer is accepted. Only when "signature_type" is "sigstore_keyless" and "sigstore_bundle" is true
+        required: false
+        type: str
+    trust_root_max_age:
+        description:
+        - Seconds after which the sigstore trust root cached in "digest_cache_dir" is refreshed with "cosign initialize". If refreshing fails, e.g. on a disconnected node, the cached trust root is still used. 0 never refreshes an initialized trust root. Only when "sigstore_bundle" is true
+        - default: 86400
+        required: false
+        type: int
+    tuf_mirror:
+        description:
+        - The TUF mirror the sigstore trust root is initialized and refreshed from. If empty, the public sigstore TUF repository is used. Only when "sigstore_bundle" is true
+        required: false
+        type: str
+    tuf_root:
+        description:
+        - A path to the initial TUF "root.json" of "tuf_mirror". Only when "sigstore_bundle" is true
+        required: false
+        type: str
+    rekor_public_key:
+        description:
+        - A path to the public key of a private rekor instance, e.g. a local stand-in, used instead of the one in the trust root. Only when "sigstore_bundle" is true
+        required: false
+        type: str
+    fulcio_root:
+        description:
+        - A path to the root certificate of a private fulcio instance, e.g. a local stand-in, used instead of the one in the trust root. Only when "sigstore_bundle" is true
+        required: false
+        type: str
+    ct_log_public_key:
+        description:
+        - A path to the public key of a private certificate transparency log, used instead of the one in the trust root. Only when "sigstore_bundle" is true
+        required: false
+        type: str
+    cosign_path:
+        description:
+        - A path to a pre-staged cosign binary, or to an offline bundle directory containing "cosign-<os>-<arch>" or "cosign". Only when "signature_type" is "sigstore" or "sigstore_keyless"
+        - If empty, cosign is looked up in PATH. Verification never downloads cosign; if no binary is found in "cosign_path" or PATH, verification fails.
+        required: false
+        type: str
+    cosign_sha256:
+        description:
+        - The expected sha256 digest of the cosign binary. If specified, a binary with a different digest is rejected.
+        required: false
+        type: str
+    digest_cache_dir:
+        description:
+        - A directory for cached state that lets unchanged content skip repeated work. It holds the digest cache ("digest-cache.json"), which maps (path, size, mtime, inode, ctime) of a file to its digests per algorithm (sha256, blake2b, blake3) and to the digests of git-lfs pointers; the gpg session homes ("gpg/"); the record of the verified cosign binary ("cosign.json"); the verdict cache and its HMAC key ("verdict-cache.json", "verdict-cache.key"); the sigstore TUF trust root ("sigstore-root/"); and the verdicts of the controller action plugin ("play-verdicts/").
+        - This is security-relevant state. Anyone who can write to it can make tampered files be signed or pass verification, so the directory must be private to the user running the module, must not be shared between users, and must not be group- or world-writable. Use "paranoid" to bypass the caches.
+        - default: $XDG_CACHE_HOME/playbook-integrity, or ~/.cache/playbook-integrity if XDG_CACHE_HOME is unset
+        required: false
+        type: str
+    metrics_file:
+        description:
+        - If specified, the metrics of every target (per-phase wall / cpu time, files and bytes hashed, subprocesses and peak RSS) are also written to this file, e.g. into the textfile collector directory of the Prometheus node_exporter. The metrics are always returned in the "metrics" key of each target result.
+        required: false
+        type: str
+    metrics_format:
+        description:
+        - Format of "metrics_file". ["prometheus"/"openmetrics"]
+        - default: "prometheus"
+        required: false
+        type: str
+    digest_algorithm:
+        description:
+        - If specified, the digest file must use this hash algorithm for its file digests. ["sha256"/"blake2b"/"blake3"]
+        - If empty, the algorithm recorded in the digest file is used, and "sha256" for a digest file without one.
+        required: false
+        type: str
+    daemon_socket:
+        description:
+        - The unix socket of a verifier daemon on the host, e.g. "~/.cache/playbook-integrity/verifyd.sock". The daemon verifies a target in full once, then watches it with inotify and only re-hashes the changed files, so later verifications of an unchanged target take milliseconds.
+        - If the daemon is not running or fails to answer, the target is verified by the module itself. If empty, or with "paranoid", no daemon is used.
+        - The daemon is started with "python3 -m ansible_collections.playbook.integrity.plugins.module_utils.verifyd --socket <path>" as the user running the module.
+        required: false
+        type: str
+    scm_type:
+        description:
+        - How the files to check are listed. ["auto"/"git"/"dir"/"archive"]
+        - With "git", the files in HEAD are listed with "git ls-tree". "dir" walks the target as a plain directory, leaving out the ignore patterns recorded in the signed digest file. "auto" uses "archive" for a file, "git" for a git work tree and "dir" otherwise.
+        - With "archive", the module reads the target tar archive once, without extracting it, and hashes every regular file as it is read; only the digest file and its signatures are copied to a scratch directory. The signed directory is the shallowest one in the archive that holds "sha256sum.txt", and files outside of it are reported as added. Files that come before the digest file in the archive are hashed with every supported algorithm; set "digest_algorithm" to hash them with one.
+        - default: "auto"
+        required: false
+        type: str
+    max_reported_differences:
+        description:
+        - Maximum number of added, removed and modified files each listed in the result when files differ from the digest file. The result always holds the total counts in "differences". 0 lists all of them.
+        - default: 1000
+        required: false
+        type: int
+    verdict_cache_ttl:
+        description:
+        - Seconds a successful signature check stays in the on-disk verdict cache in "digest_cache_dir". While it is cached, the same digest file and signature at the same HEAD commit is not verified again with gpg / cosign; the files are still checked against the digest file. 0 disables the cache.
+        - The cache is only used with "public_key" or "sigstore_keyless", and not with "paranoid".
+        - default: 3600
+        required: false
+        type: int
+    run_on:
+        description:
+        - Where the verification runs. ["remote"/"controller"]
+        - With "controller", the target is a path on the controller, e.g. a project directory shared by all hosts. It is verified once per play for each (target, HEAD commit, sha256 of the digest file), and every host gets that verdict; "metrics_file" is written on the controller.
+        - default: "remote"
+        required: false
+        type: str
+    compare_remote_manifest:
+        description:
+        - Only when "run_on" is "controller". If true, the digest file of the target on each host must also be identical to the one verified on the controller.
+        - default: false
+        required: false
+        type: bool
+    signers:
+        description:
+        - A list of signers whose signatures "sha256sum.txt.<name>.sig" ("sha256sum.txt.<name>.bundle" with "sigstore_bundle") of the digest file are verified, as written by the "signers" option of the sign module. The options of a signer override those of the task, and "name" defaults to the signature type.
+        - The signatures are checked in parallel while the files are hashed, and the remaining checks are cancelled once "signature_policy" is decided.
+        - If empty, the task options verify "sha256sum.txt.sig".
+        required: false
+        type: list
+        elements: dict
+        suboptions:
+            name:
+                description:
+                - The name of the signer in the signature filename.
+                type: str
+            signature_type:
+                description:
+                - Signature type of this signer. ["gpg"/"sigstore"/"sigstore_keyless"]
+                type: str
+            public_key:
+                description:
+                - The public key of this signer, as in "public_key".
+                type: str
+            keyless_signer_id:
+                description:
+                - The certificate identity of this signer, as in "keyless_signer_id".
+                type: str
+            keyless_oidc_issuer:
+                description:
+                - The certificate OIDC issuer of this signer, as in "keyless_oidc_issuer".
+                type: str
+            sigstore_bundle:
+                description:
+                - Whether this signer is verified from its signature bundle, as in "sigstore_bundle".
+                type: bool
+    signature_policy:
+        description:
+        - How many of the "signers" must have a valid signature. ["all"/"any"/"k-of-n"]
+        - With "k-of-n", "signature_threshold" of them are required.
+        - default: "all"
+        required: false
+        type: str
+    signature_threshold:
+        description:
+        - The number of valid signatures required when "signature_policy" is "k-of-n".
+        required: false
+        type: int
     
 # Specify this value according to your collection
 # in format of namespace.collection.doc_fragment_name
@@ -61,6 +269,51 @@ EXAMPLES = r'''
   playbook.integrity.verify:
     type: playbook
     target: path/to/playbookrepo
+
+# Verify many playbook SCM repos in one task
+- name: Verify playbook SCM repos
+  playbook.integrity.verify:
+    type: playbook
+    targets:
+      - path/to/playbookrepo1
+      - path/to/playbookrepo2
+    max_parallel_targets: 8
+
+# Verify a project directory once on the controller for all hosts of the play
+- name: Verify a shared playbook SCM repo on the controller
+  playbook.integrity.verify:
+    type: playbook
+    target: path/to/playbookrepo
+    run_on: controller
+    compare_remote_manifest: true
+
+# Ask a verifier daemon running on the host, and verify in the module if it is not running
+- name: Verify a playbook SCM repo through the verifier daemon
+  playbook.integrity.verify:
+    type: playbook
+    target: path/to/playbookrepo
+    daemon_socket: ~/.cache/playbook-integrity/verifyd.sock
+
+# Verify a packed project without extracting it
+- name: Verify a playbook project archive
+  playbook.integrity.verify:
+    type: playbook
+    target: path/to/playbookrepo.tar.gz
+
+# Require two of three signatures
+- name: Verify a playbook SCM repo signed by several signers
+  playbook.integrity.verify:
+    type: playbook
+    target: path/to/playbookrepo
+    signers:
+      - name: release
+        public_key: path/to/release.gpg
+      - name: security
+        public_key: path/to/security.gpg
+      - signature_type: sigstore
+        public_key: path/to/cosign.pub
+    signature_policy: k-of-n
+    signature_threshold: 2
 '''
 
 RETURN = r'''
@@ -80,17 +333,61 @@ message:
 import traceback
 from ansible.module_utils.basic import AnsibleModule
 from ansible_collections.playbook.integrity.plugins.module_utils.verify import Verifier
+from ansible_collections.playbook.integrity.plugins.module_utils.batch import run_targets
+from ansible_collections.playbook.integrity.plugins.module_utils.metrics import result_samples, write_metrics_file
+
+# define available arguments/parameters a user can pass to the module.
+# the action plugin validates the same arguments when verifying on the controller.
+module_args = dict(
+    type=dict(type='str', required=False, default="playbook"),
+    target=dict(type='str', required=False),
+    targets=dict(type='list', elements='str', required=False),
+    max_parallel_targets=dict(type='int', required=False, default=4),
+    signature_type=dict(type='str', required=False, default="gpg"),
+    public_key=dict(type='str', required=False, default=""),
+    keyless_signer_id=dict(type='str', required=False, default=""),
+    workers=dict(type='int', required=False, default=0),
+    hash_pool=dict(type='str', required=False, default="thread"),
+    paths=dict(type='list', elements='str', required=False),
+    concurrent_stages=dict(type='bool', required=False, default=True),
+    paranoid=dict(type='bool', required=False, default=False),
+    digest_cache_dir=dict(type='str', required=False, default=""),
+    metrics_file=dict(type='str', required=False, default=""),
+    metrics_format=dict(type='str', required=False, default="prometheus"),
+    sigstore_bundle=dict(type='bool', required=False, default=False),
+    keyless_oidc_issuer=dict(type='str', required=False, default=""),
+    trust_root_max_age=dict(type='int', required=False, default=86400),
+    tuf_mirror=dict(type='str', required=False, default=""),
+    tuf_root=dict(type='str', required=False, default=""),
+    rekor_public_key=dict(type='str', required=False, default=""),
+    fulcio_root=dict(type='str', required=False, default=""),
+    ct_log_public_key=dict(type='str', required=False, default=""),
+    cosign_path=dict(type='str', required=False, default=""),
+    cosign_sha256=dict(type='str', required=False, default=""),
+    scm_type=dict(type='str', required=False, default="auto"),
+    daemon_socket=dict(type='str', required=False, default=""),
+    digest_algorithm=dict(type='str', required=False, default=""),
+    signers=dict(type='list', elements='dict', required=False, default=[], options=dict(
+        name=dict(type='str'),
+        signature_type=dict(type='str'),
+        public_key=dict(type='str'),
+        keyless_signer_id=dict(type='str'),
+        keyless_oidc_issuer=dict(type='str'),
+        sigstore_bundle=dict(type='bool'),
+    )),
+    signature_policy=dict(type='str', required=False, default="all"),
+    signature_threshold=dict(type='int', required=False),
+    max_reported_differences=dict(type='int', required=False, default=1000),
+    verdict_cache_ttl=dict(type='int', required=False, default=3600),
+    run_on=dict(type='str', required=False, default="remote"),
+    compare_remote_manifest=dict(type='bool', required=False, default=False),
+    action=dict(type='str', required=False, default="fail")
+)
+required_one_of = [["target", "targets"]]
+mutually_exclusive = [["target", "targets"]]
+
 
 def run_module():
-    # define available arguments/parameters a user can pass to the module
-    module_args = dict(
-        type=dict(type='str', required=False, default="playbook"),
-        target=dict(type='str', required=True),
-        signature_type=dict(type='str', required=False, default="gpg"),
-        public_key=dict(type='str', required=False, default=""),
-        keyless_signer_id=dict(type='str', required=False, default=""),
-        action=dict(type='str', required=False, default="fail")
-    )
 
     # seed the result dict in the object
     # we primarily care about changed and state
@@ -108,6 +405,8 @@ def run_module():
     # supports check mode
     module = AnsibleModule(
         argument_spec=module_args,
+        required_one_of=required_one_of,
+        mutually_exclusive=mutually_exclusive,
         supports_check_mode=True
     )
 
@@ -120,13 +419,23 @@ def run_module():
     # manipulate or modify the state as needed (this is going to be the
     # part where your module will do what it needs to do)
 
-    verifier = Verifier(module.params)
-    try:
-        verify_result = verifier.verify()
-    except Exception:
-        verify_result = {"failed": True}
-        verify_result["traceback"] = traceback.format_exc()
-    result['detail'] = verify_result
+    if module.params["targets"]:
+        verify_result = run_targets(module.params, module.params["targets"], lambda params: Verifier(params).verify(), max_parallel=module.params["max_parallel_targets"])
+        result['detail'] = verify_result
+    else:
+        verifier = Verifier(module.params)
+        try:
+            verify_result = verifier.verify()
+        except Exception:
+            verify_result = {"failed": True}
+            verify_result["traceback"] = traceback.format_exc()
+        result['detail'] = verify_result
+
+    if module.params["metrics_file"]:
+        try:
+            write_metrics_file(module.params["metrics_file"], result_samples("verify", module.params, verify_result), metrics_format=module.params["metrics_format"])
+        except (OSError, ValueError) as e:
+            module.warn("failed to write the metrics file \"{}\"; {}".format(module.params["metrics_file"], e))
 
     # use whatever logic you need to determine whether or not this module
     # made any modifications to your target
@@ -0,0 +1,74 @@
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import subprocess
+
+import pytest
+
+import ansible_collections.playbook.integrity.plugins.module_utils.common as common
+
+
+def git(cwd, *args):
+    argv = ["git", "-c", "user.email=test@example.com", "-c", "user.name=test"] + list(args)
+    return subprocess.run(argv, cwd=cwd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True).stdout
+
+
+@pytest.fixture
+def repo(tmp_path):
+    path = str(tmp_path / "repo")
+    os.makedirs(path)
+    git(path, "init", "-q")
+    for fname in ["site.yml", "other.yml"]:
+        with open(os.path.join(path, fname), "w") as f:
+            f.write(fname)
+    git(path, "add", ".")
+    git(path, "commit", "-q", "-m", "initial")
+    return path
+
+
+# files that git is told not to compare must still be hashed, or a change could be hidden from verification
+@pytest.mark.parametrize("flag", ["--assume-unchanged", "--skip-worktree"])
+def test_git_object_check_rehashes_hidden_files(repo, flag):
+    assert common.Digester(repo, digest_mode=common.DIGEST_MODE_GIT_OBJECT).gen()["returncode"] == 0
+    with open(os.path.join(repo, "site.yml"), "a") as f:
+        f.write("tampered")
+    git(repo, "update-index", flag, "site.yml")
+    assert git(repo, "status", "--porcelain", "--untracked-files=no") == ""
+
+    result = common.Digester(repo).check()
+    assert result["returncode"] == 1
+    assert result["modified"] == ["site.yml"]
+
+
+@pytest.mark.parametrize("flag", ["--assume-unchanged", "--skip-worktree"])
+def test_incremental_gen_rehashes_hidden_files(repo, flag):
+    assert common.Digester(repo).gen(incremental=True)["returncode"] == 0
+    git(repo, "commit", "-q", "--allow-empty", "-m", "second")
+    with open(os.path.join(repo, "site.yml"), "a") as f:
+        f.write("changed")
+    git(repo, "update-index", flag, "site.yml")
+
+    result = common.Digester(repo).gen(incremental=True)
+    assert result["returncode"] == 0
+    # the working tree differs from HEAD, so the digest file must not become an incremental base
+    assert result["incremental"]["commit"] is None
+    assert common.Digester(repo).check()["returncode"] == 0
+
+
+def test_incremental_gen_fails_on_deleted_file(repo):
+    assert common.Digester(repo).gen(incremental=True)["returncode"] == 0
+    git(repo, "commit", "-q", "--allow-empty", "-m", "second")
+    os.remove(os.path.join(repo, "site.yml"))
+
+    full = common.Digester(repo).gen()
+    assert full["returncode"] == 1
+    git(repo, "checkout", "-q", "site.yml")
+    assert common.Digester(repo).gen(incremental=True)["returncode"] == 0
+    git(repo, "commit", "-q", "--allow-empty", "-m", "third")
+    os.remove(os.path.join(repo, "site.yml"))
+
+    result = common.Digester(repo).gen(incremental=True)
+    assert result["returncode"] == 1
+    assert "site.yml" in result["stderr"]